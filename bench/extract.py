@@ -0,0 +1,104 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract import LexborHTMLParser, MemberPageExtractor, extract_member_page, extract_member_page_lexbor
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "fixtures", "show")
+
+# Roughly what follows the first recorded movie on a real /show/ page, the other movies, the comment list,
+# the footer and the inline scripts
+FILLER = ('<div class="recorded-movie-box"><a class="tw-movie-thumbnail2" href="/user/movie/1">'
+          '<img class="tw-movie-thumbnail2-image" src="https://mock/1.jpg" title="2024/01/01 20:00">'
+          '<span class="tw-movie-thumbnail2-title">older live</span>'
+          '<span class="tw-movie-thumbnail2-label">older subtitle</span></a></div>\n'
+          '<div class="tw-comment-item"><span class="tw-comment-item-name">name</span>'
+          '<span class="tw-comment-item-comment">コメント &amp; text</span></div>\n')
+
+
+# The BeautifulSoup lookups the script used before extract.py
+def extract_member_page_bs4(user_id, page_res):
+    soup = BeautifulSoup(page_res, "html.parser")
+    first_video_element = soup.find("div", class_="recorded-movie-box").find("a", class_="tw-movie-thumbnail2")
+    member_icon = first_video_element.find("img", class_="tw-movie-thumbnail2-title-icon")['src']
+    title = first_video_element.find("span", class_="tw-movie-thumbnail2-title").text.strip()
+    label = first_video_element.find("span", class_="tw-movie-thumbnail2-label")
+    subtitle = label.text.strip() if label is not None else title
+    is_protected = len(first_video_element.find("span", class_="tw-movie-thumbnail2-title")
+                       .find_all("img", class_="tw-movie-thumbnail2-title-icon")) > 1
+    image = soup.find("div", class_="tw-user-nav2-icon").find("img", recursive=False)['src']
+    thumbnail = first_video_element.find("img", class_="tw-movie-thumbnail2-image")
+    return "member" in member_icon, {'title': title, 'subtitle': subtitle, 'is_protected': is_protected,
+                                     'date': thumbnail['title'][:10].replace("/", ""), 'image': f'https:{image}',
+                                     'thumbnail': thumbnail['src']}
+
+
+# The fixture with filler inserted before </body>, so the movie and the icon stay where they are on a real page
+def load_pages(padding):
+    pages = {}
+    for name in sorted(os.listdir(FIXTURES)):
+        if name.endswith(".html"):
+            with open(os.path.join(FIXTURES, name), encoding="utf-8") as page_file:
+                page = page_file.read()
+            pages[name] = page.replace("</body>", FILLER * padding + "</body>")
+    return pages
+
+
+# Share of the page the streaming extractor reads before it stops, the rest of the response is never downloaded
+def consumed(page, chunk_size=16384):
+    data = page.encode("utf-8")
+    extractor = MemberPageExtractor()
+    for start in range(0, len(data), chunk_size):
+        if extractor.feed_bytes(data[start:start + chunk_size]):
+            return min(len(data), start + chunk_size) / len(data)
+    return 1.0
+
+
+def timed(function, pages, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for name, page in pages.items():
+            function("user", page)
+    return (time.perf_counter() - started) / (repeat * len(pages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the /show/ page extractors on the saved fixtures")
+    parser.add_argument("--padding", type=int, default=600, help="filler blocks appended to every page(~300 bytes each)")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    pages = load_pages(args.padding)
+    backends = {'stream': lambda user_id, page: extract_member_page(user_id, page)}
+    if LexborHTMLParser is not None:
+        backends['lexbor'] = extract_member_page_lexbor
+    if BeautifulSoup is not None:
+        backends['bs4'] = extract_member_page_bs4
+    expected = {name: extract_member_page("user", page) for name, page in pages.items()}
+    results = {}
+    for backend, function in backends.items():
+        # Every backend has to agree with the streaming extractor before its time means anything
+        for name, page in pages.items():
+            if function("user", page) != expected[name]:
+                print(f"{backend} disagrees on {name}: {function('user', page)} != {expected[name]}")
+        results[backend] = timed(function, pages, args.repeat)
+    size = sum(len(page.encode("utf-8")) for page in pages.values()) / len(pages)
+    read = sum(consumed(page) for page in pages.values()) / len(pages)
+    summary = [f"page_kb={size / 1024:.0f}", f"stream_reads={read:.1%}"]
+    summary += [f"{backend}_ms={seconds * 1000:.3f}" for backend, seconds in results.items()]
+    if 'bs4' in results:
+        summary += [f"{backend}_speedup={results['bs4'] / seconds:.1f}x" for backend, seconds in results.items()
+                    if backend != 'bs4']
+    print(" | ".join(summary))
+
+
+if __name__ == "__main__":
+    main()
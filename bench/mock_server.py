@@ -0,0 +1,201 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from aiohttp import web
+
+
+SHOW_PAGE = """<!DOCTYPE html><html><head><meta charset="utf-8"><title>{user_id}</title></head><body>
+<div class="tw-user-nav2"><div class="tw-user-nav2-icon"><img src="//mock/{user_id}/icon.jpg"></div></div>
+<div class="recorded-movie-box"><a class="tw-movie-thumbnail2" href="/{user_id}/movie/{movie_id}">
+<img class="tw-movie-thumbnail2-image" src="https://mock/{movie_id}.jpg" title="{date} 20:00">
+<span class="tw-movie-thumbnail2-title"><img class="tw-movie-thumbnail2-title-icon" src="/img/{icon}.png">{title}</span>
+<span class="tw-movie-thumbnail2-label">subtitle of {movie_id}</span></a></div>
+{filler}</body></html>"""
+
+
+class SyntheticUser:
+    def __init__(self, user_id, index, live_at=None, member_only=False):
+        self.user_id = user_id
+        self.numeric_id = str(100000 + index)
+        self.movie_id = 700000000 + index
+        self.live_at = live_at
+        self.member_only = member_only
+
+    def is_live(self, now):
+        return self.live_at is not None and now >= self.live_at
+
+    def movie(self, now):
+        return {'id': str(self.movie_id), 'user_id': self.numeric_id, 'title': f"live of {self.user_id}",
+                'subtitle': None, 'last_owner_comment': None, 'is_live': self.is_live(now), 'is_protected': False,
+                'created': int(self.live_at or now), 'large_thumbnail': f"https://mock/{self.movie_id}.jpg",
+                'small_thumbnail': f"https://mock/{self.movie_id}-s.jpg"}
+
+    def profile(self):
+        return {'id': self.numeric_id, 'screen_id': self.user_id, 'name': self.user_id,
+                'image': f"https://mock/{self.user_id}/icon.jpg", 'is_live': False}
+
+
+# Stand-in for streamserver.php, apiv2, frontendapi, the /show/ pages and a discord webhook
+# with configurable latency, error and 429 rates and users that go live on a schedule
+class MockTwitcasting:
+    def __init__(self, users=100, live_ratio=0.1, live_window=10.0, member_ratio=0.2, latency=0.0,
+                 error_rate=0.0, throttle_rate=0.0, page_padding=200, segment_count=30, comment_rate=5.0, seed=0):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.page_padding = page_padding
+        self.segment_count = segment_count
+        self.comment_rate = comment_rate
+        self.started = time.time()
+        self.users = {}
+        for index in range(users):
+            user_id = f"user{index:05d}"
+            live_at = None
+            if self.random.random() < live_ratio:
+                live_at = self.started + self.random.uniform(0, live_window)
+            self.users[user_id] = SyntheticUser(user_id, index, live_at, self.random.random() < member_ratio)
+        self.requests = Counter()
+        self.webhook_embeds = 0
+        self.runner = None
+        self.url = None
+
+    def live_users(self, now=None):
+        now = time.time() if now is None else now
+        return [user for user in self.users.values() if user.is_live(now)]
+
+    @web.middleware
+    async def faults(self, request, handler):
+        self.requests[request.match_info.route.name or "unknown"] += 1
+        if self.latency:
+            await asyncio.sleep(self.random.expovariate(1 / self.latency))
+        roll = self.random.random()
+        if roll < self.throttle_rate:
+            return web.json_response({'retry_after': 0.5}, status=429, headers={'Retry-After': "1"})
+        if roll < self.throttle_rate + self.error_rate:
+            return web.Response(text="<html>error</html>", status=503)
+        return await handler(request)
+
+    def user(self, request):
+        user = self.users.get(request.match_info['user_id'])
+        if user is None:
+            raise web.HTTPNotFound()
+        return user
+
+    async def stream_server(self, request):
+        user = self.users.get(request.query.get('target'))
+        if user is None:
+            return web.json_response({})
+        res = {'movie': {'id': user.movie_id, 'live': user.is_live(time.time())}}
+        if res['movie']['live'] and not user.member_only:
+            res['tc-hls'] = {'streams': {'main': f"{self.url}/hls/{user.user_id}/index.m3u8"}}
+        return web.json_response(res)
+
+    async def current_live(self, request):
+        user, now = self.user(request), time.time()
+        if not user.is_live(now) or user.member_only:
+            return web.json_response({'error': {'code': 404, 'message': "Not Found"}}, status=404)
+        return web.json_response({'movie': user.movie(now), 'broadcaster': user.profile(), 'tags': []})
+
+    async def movies(self, request):
+        user = self.user(request)
+        return web.json_response({'total_count': 1, 'movies': [user.movie(time.time())]})
+
+    async def profile(self, request):
+        user = self.user(request)
+        etag = f'"{user.numeric_id}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.json_response({'user': user.profile()}, headers={'ETag': etag})
+
+    async def search_lives(self, request):
+        now = time.time()
+        lives = sorted(self.live_users(now), key=lambda user: user.live_at, reverse=True)[:100]
+        return web.json_response({'movies': [{'movie': user.movie(now), 'broadcaster': user.profile()}
+                                             for user in lives]})
+
+    async def latest_movie(self, request):
+        user, now = self.user(request), time.time()
+        return web.json_response({'movie': {'id': user.movie_id,
+                                            'is_on_live': user.is_live(now) and not user.member_only}})
+
+    async def show_page(self, request):
+        user = self.user(request)
+        return web.Response(text=SHOW_PAGE.format(user_id=user.user_id, movie_id=user.movie_id, date="2024/01/01",
+                                                  icon="member" if user.member_only else "live",
+                                                  title=f"live of {user.user_id}",
+                                                  filler="<p>filler</p>" * self.page_padding),
+                            content_type="text/html")
+
+    # Sliding window live playlist with one second segments, the live ends after segment_count segments
+    async def hls_playlist(self, request):
+        user, now = self.user(request), time.time()
+        if not user.is_live(now):
+            raise web.HTTPNotFound()
+        newest = int(now - user.live_at)
+        ended = newest >= self.segment_count
+        newest = min(newest, self.segment_count - 1)
+        first = max(0, newest - 2)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:1", f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+        for sequence in range(first, newest + 1):
+            lines += ["#EXTINF:1.0,", f"{sequence}.ts"]
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        return web.Response(text="\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl")
+
+    async def hls_segment(self, request):
+        user = self.user(request)
+        sequence = int(request.match_info['sequence'])
+        return web.Response(body=f"{user.user_id}:{sequence};".encode() * 64, content_type="video/mp2t")
+
+    # comment_rate comments a second since the live started, like apiv2 the newest come first, slice_id only
+    # returns the ones after it and offset is ignored when slice_id is given
+    async def comments(self, request):
+        movie_id = int(request.match_info['movie_id'])
+        user = next((user for user in self.users.values() if user.movie_id == movie_id), None)
+        if user is None or user.live_at is None:
+            raise web.HTTPNotFound()
+        total = int(max(0.0, time.time() - user.live_at) * self.comment_rate)
+        first_id = movie_id * 100000
+        after = int(request.query.get('slice_id', first_id - 1)) - first_id + 1
+        limit = int(request.query.get('limit', 10))
+        offset = 0 if 'slice_id' in request.query else int(request.query.get('offset', 0))
+        numbers = range(total - 1 - offset, max(after, 0) - 1, -1)[:limit]
+        return web.json_response({'movie_id': str(movie_id), 'all_count': total,
+                                  'comments': [{'id': str(first_id + number), 'message': f"comment {number}",
+                                                'from_user': user.profile(), 'created': int(user.live_at) + number}
+                                               for number in numbers]})
+
+    async def webhook(self, request):
+        body = await request.json()
+        self.webhook_embeds += len(body.get('embeds', []))
+        return web.Response(status=204)
+
+    def app(self):
+        app = web.Application(middlewares=[self.faults])
+        app.router.add_get("/streamserver.php", self.stream_server, name="streamserver")
+        app.router.add_get("/apiv2/users/{user_id}/current_live", self.current_live, name="current_live")
+        app.router.add_get("/apiv2/users/{user_id}/movies", self.movies, name="movies")
+        app.router.add_get("/apiv2/users/{user_id}", self.profile, name="users")
+        app.router.add_get("/apiv2/search/lives", self.search_lives, name="search_lives")
+        app.router.add_get("/apiv2/movies/{movie_id}/comments", self.comments, name="comments")
+        app.router.add_get("/frontendapi/users/{user_id}/latest-movie", self.latest_movie, name="latest_movie")
+        app.router.add_get("/{user_id}/show/", self.show_page, name="show")
+        app.router.add_get("/hls/{user_id}/index.m3u8", self.hls_playlist, name="hls_playlist")
+        app.router.add_get("/hls/{user_id}/{sequence}.ts", self.hls_segment, name="hls_segment")
+        app.router.add_post("/webhook", self.webhook, name="webhook")
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
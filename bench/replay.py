@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.mock_server import SyntheticUser
+from push import PushReceiver
+
+
+# Synthetic livestart/liveend webhooks in the shape twitcasting sends them
+def synthetic_events(users, live_ratio, duration, duplicate_rate, seed):
+    rng = random.Random(seed)
+    started = time.time()
+    events = []
+    for index in range(users):
+        if rng.random() >= live_ratio:
+            continue
+        user = SyntheticUser(f"user{index:05d}", index, started + rng.uniform(0, duration * 0.5))
+        end = user.live_at + rng.uniform(0, duration * 0.5)
+        for at, is_live in ((user.live_at, True), (end, False)):
+            movie = dict(user.movie(at), is_live=is_live)
+            events.append({'at': at - started, 'movie': movie, 'broadcaster': user.profile()})
+            if rng.random() < duplicate_rate:
+                events.append({'at': at - started + rng.uniform(0, 1), 'movie': movie, 'broadcaster': user.profile()})
+    return sorted(events, key=lambda event: event['at'])
+
+
+def load_events(path):
+    with open(path, encoding="utf-8") as events_file:
+        return [json.loads(line) for line in events_file if line.strip()]
+
+
+# Posts the events to url at the times they happened(scaled by speed) and returns the response times
+async def replay(url, signature, events, speed=1.0):
+    latencies = []
+    statuses = {}
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        for event in events:
+            delay = event.get('at', 0) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            payload = {'signature': signature, 'movie': event['movie'], 'broadcaster': event['broadcaster']}
+            sent = time.monotonic()
+            async with session.post(url, json=payload) as res:
+                statuses[res.status] = statuses.get(res.status, 0) + 1
+            latencies.append(time.monotonic() - sent)
+    return latencies, statuses
+
+
+async def self_test(args, events, logger):
+    received = []
+    receiver = PushReceiver(logger, args.signature, lambda movie, broadcaster: received.append(time.monotonic()))
+    await receiver.start("127.0.0.1", args.port, "/")
+    latencies, statuses = await replay(f"http://127.0.0.1:{args.port}/", args.signature, events, args.speed)
+    # A wrongly signed event has to be rejected
+    forged, forged_statuses = await replay(f"http://127.0.0.1:{args.port}/", "wrong", events[:1])
+    await receiver.close()
+    return latencies, statuses, len(received), forged_statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay twitcasting livestart/liveend webhooks against a receiver")
+    parser.add_argument("--url", help="receiver to post to, e.g. http://127.0.0.1:8000/ for PUSH_PORT = 8000. "
+                                      "Without it a receiver is started in this process and checked")
+    parser.add_argument("--signature", default="bench-signature", help="must match PUSH_SIGNATURE")
+    parser.add_argument("--events", help="ndjson file with one {at, movie, broadcaster} event per line")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--live-ratio", type=float, default=0.1)
+    parser.add_argument("--duration", type=float, default=10, help="seconds the synthetic events are spread over")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="share of events delivered twice")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay faster(>1) or slower than real time")
+    parser.add_argument("--port", type=int, default=18080, help="port of the in-process receiver")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+    logger = logging.getLogger("bench")
+    if args.events:
+        events = load_events(args.events)
+    else:
+        events = synthetic_events(args.users, args.live_ratio, args.duration, args.duplicate_rate, args.seed)
+    if args.url:
+        latencies, statuses = asyncio.run(replay(args.url, args.signature, events, args.speed))
+        handled = forged = None
+    else:
+        latencies, statuses, handled, forged = asyncio.run(self_test(args, events, logger))
+    latencies.sort()
+    result = {'events': len(events), 'statuses': statuses,
+              'response_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+              'response_p95': latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] if latencies else 0.0}
+    if handled is not None:
+        result['handled'] = handled
+        result['duplicates_dropped'] = len(events) - handled
+        result['forged_statuses'] = forged
+    print(" | ".join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}"
+                     for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
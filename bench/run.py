@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import endpoints
+from bench.mock_server import MockTwitcasting
+from bulk import BulkDetector
+from cache import MetadataCache
+from extract import MemberPageError, MemberPageExtractor
+from notifier import WebhookNotifier
+from poller import LivePoller
+from ratelimit import DEFAULT_LIMITS, RateLimiter
+from scheduler import PollScheduler
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_memory_mb():
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Same chain of requests index.py makes for a user that just went live, against the mock server
+async def enrich(poller, cache, notifier, user_id):
+    status, res = await poller.request(f"{endpoints.API_URL}/users/{user_id}/current_live")
+    await poller.request(f"{endpoints.FRONTEND_API_URL}/users/{user_id}/latest-movie")
+    if status == 404:
+        await cache.fetch(poller, ('movies', user_id), f"{endpoints.API_URL}/users/{user_id}/movies?limit=1", 15)
+        await cache.fetch(poller, ('user', user_id), f"{endpoints.API_URL}/users/{user_id}", 3600)
+        extractor = MemberPageExtractor()
+        await poller.stream(f"{endpoints.SITE_URL}/{user_id}/show/", extractor.feed_bytes)
+        try:
+            extractor.result(user_id)
+        except MemberPageError:
+            pass
+    notifier.notify({"author": {"name": user_id}, "fields": [{"name": user_id, "value": user_id}]})
+
+
+async def run_case(poller, args, user_count, logger):
+    mock = MockTwitcasting(users=user_count, live_ratio=args.live_ratio, live_window=args.duration * 0.6,
+                           latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                           seed=args.seed)
+    url = await mock.start()
+    endpoints.configure(api_url=f"{url}/apiv2", frontend_api_url=f"{url}/frontendapi", site_url=url)
+    session = await poller.start()
+    notifier = WebhookNotifier(logger, f"{url}/webhook", batch_window=0.2)
+    notifier.start(session)
+    cache = MetadataCache()
+    users = list(mock.users)
+    scheduler = PollScheduler(users, min_interval=args.interval, max_interval=args.max_latency) \
+        if args.mode == "scheduled" else None
+    bulk = BulkDetector(logger, poller, dict, interval=args.interval * 5) if args.mode == "scheduled" else None
+
+    detected = {}
+    cycle_times = []
+    enrich_times = []
+    cycles = 0
+    cpu_started = time.process_time()
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        cycle_started = time.monotonic()
+        if scheduler is None:
+            lives = await poller.get_lives(users)
+        else:
+            lives = await bulk.fetch(users) if bulk.is_due() else []
+            for res, user_id in lives:
+                scheduler.defer(user_id, bulk.interval)
+            due_users = scheduler.due_users()
+            polled = await poller.get_lives(due_users) if due_users else []
+            for res, user_id in polled:
+                scheduler.record(user_id, bool(res.get('movie', {}).get('live')))
+            lives += polled
+        cycle_times.append(time.monotonic() - cycle_started)
+        cycles += 1
+        newly_live = []
+        for res, user_id in lives:
+            if res.get('movie', {}).get('live') and user_id not in detected:
+                detected[user_id] = time.time()
+                newly_live.append(user_id)
+        if newly_live:
+            enrich_started = time.monotonic()
+            await asyncio.gather(*(enrich(poller, cache, notifier, user_id) for user_id in newly_live),
+                                 return_exceptions=True)
+            enrich_times.append(time.monotonic() - enrich_started)
+        await asyncio.sleep(max(0.0, args.interval - (time.monotonic() - cycle_started)))
+    cpu_seconds = time.process_time() - cpu_started
+    await notifier.close(timeout=5)
+
+    latencies = [detected[user.user_id] - user.live_at for user in mock.live_users() if user.user_id in detected]
+    went_live = len(mock.live_users())
+    result = {
+        'users': user_count,
+        'mode': args.mode,
+        'cycles': cycles,
+        'cycle_mean': sum(cycle_times) / max(1, len(cycle_times)),
+        'cycle_p95': percentile(cycle_times, 0.95),
+        'requests_per_cycle': sum(mock.requests.values()) / max(1, cycles),
+        'detected': f"{len(latencies)}/{went_live}",
+        'detection_mean': sum(latencies) / max(1, len(latencies)),
+        'detection_p95': percentile(latencies, 0.95),
+        'enrich_p95': percentile(enrich_times, 0.95),
+        'webhook_embeds': mock.webhook_embeds,
+        'cpu_seconds': cpu_seconds,
+        'peak_rss_mb': peak_memory_mb(),
+    }
+    await poller.close()
+    await mock.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the poller against a local mock twitcasting server")
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--mode", choices=["all", "scheduled"], default="all",
+                        help="poll every user every cycle or use the adaptive scheduler with bulk detection")
+    parser.add_argument("--duration", type=float, default=15, help="seconds each case runs for")
+    parser.add_argument("--interval", type=float, default=1, help="seconds between poll cycles")
+    parser.add_argument("--max-latency", type=float, default=60, help="worst case latency of the scheduler")
+    parser.add_argument("--live-ratio", type=float, default=0.1, help="share of the users that go live")
+    parser.add_argument("--latency", type=float, default=0.01, help="mean server latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument("--rate", type=float, default=100000, help="requests per second allowed for each endpoint")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+    logger = logging.getLogger("bench")
+    results = []
+    for user_count in args.users:
+        limits = {family: {'rate': args.rate, 'period': 1, 'capacity': args.rate} for family in DEFAULT_LIMITS}
+        poller = LivePoller(logger, RateLimiter(logger, limits), concurrency=args.concurrency)
+        try:
+            result = poller.run(run_case(poller, args, user_count, logger))
+        finally:
+            poller.shutdown()
+        results.append(result)
+        print(" | ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                         for key, value in result.items()), flush=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import asyncio
+import json
+import time
+import aiohttp
+import endpoints
+
+
+# Detects go-lives of many users at once through the apiv2 live search, which returns up to 100 lives per request.
+# The api has no batch lookup of users so this can only prove that a user is live, users that aren't found are
+# still checked by the per user polling but much less often while this source is healthy
+class BulkDetector:
+    def __init__(self, logger, poller, headers, sources=('new',), interval=10, timeout=10):
+        self.logger = logger
+        self.poller = poller
+        self.headers = headers
+        self.sources = sources
+        self.interval = interval
+        self.timeout = timeout
+        self.next_fetch = 0
+        self.last_success = None
+
+    def is_due(self, now=None):
+        now = time.time() if now is None else now
+        return bool(self.sources) and now >= self.next_fetch
+
+    @property
+    def healthy(self):
+        return self.last_success is not None and time.time() - self.last_success < self.interval * 3
+
+    async def search(self, source):
+        params = {'type': source, 'limit': 100, 'lang': 'ja'}
+        try:
+            status, res = await self.poller.request(f"{endpoints.API_URL}/search/lives", headers=self.headers(),
+                                                    params=params, timeout=self.timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as error:
+            self.logger.debug(f"Live search ({source}) failed: {error!r}")
+            return None
+        if status != 200 or 'movies' not in res:
+            self.logger.debug(f"Live search ({source}) returned {status}: {res}")
+            return None
+        return res['movies']
+
+    # Returns the watched users found live in the same (res, user_id) shape get_lives() returns
+    async def fetch(self, user_ids):
+        self.next_fetch = time.time() + self.interval
+        watched = {}
+        for user_id in user_ids:
+            watched[str(user_id).lower()] = user_id
+        results = await asyncio.gather(*(self.search(source) for source in self.sources))
+        if all(movies is None for movies in results):
+            return []
+        self.last_success = time.time()
+        lives = {}
+        for movies in results:
+            for entry in movies or []:
+                movie = entry.get('movie', {})
+                broadcaster = entry.get('broadcaster', {})
+                user_id = watched.get(str(broadcaster.get('screen_id', '')).lower()) or \
+                    watched.get(str(broadcaster.get('id', '')).lower())
+                if user_id is None or not movie.get('is_live'):
+                    continue
+                lives[user_id] = {'movie': {'id': movie['id'], 'live': True}, 'bulk': entry}
+        return [(res, user_id) for user_id, res in lives.items()]
@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    def __init__(self, value, expires, etag=None, last_modified=None):
+        self.value = value
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+# TTL + LRU cache for user profiles and movie metadata shared by every enrichment path
+# Expired entries are kept around with their ETag/Last-Modified so they can be revalidated with a 304
+class MetadataCache:
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry.expires < time.time():
+            return None
+        self.entries.move_to_end(key)
+        return entry.value
+
+    def put(self, key, value, ttl, etag=None, last_modified=None):
+        self.entries[key] = CacheEntry(value, time.time() + ttl, etag, last_modified)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    # GET through the poller unless a fresh copy is cached, returns the status and body like poller.request()
+    async def fetch(self, poller, key, url, ttl, headers=None, params=None, timeout=None, as_json=True):
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return 200, value
+        self.misses += 1
+        entry = self.entries.get(key)
+        headers = dict(headers or {})
+        if entry is not None:
+            if entry.etag is not None:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified is not None:
+                headers['If-Modified-Since'] = entry.last_modified
+        status, body, res_headers = await poller.request(url, headers=headers, params=params, timeout=timeout,
+                                                         as_json=as_json, with_headers=True)
+        if status == 304 and entry is not None:
+            self.put(key, entry.value, ttl, entry.etag, entry.last_modified)
+            return 200, entry.value
+        if status == 200:
+            self.put(key, body, ttl, res_headers.get('ETag'), res_headers.get('Last-Modified'))
+        return status, body
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+import aiohttp
+import zstandard as zstd
+import endpoints
+from metrics import metrics
+
+
+# Archives the comments of one live to zstd compressed ndjson(one comment per line) next to its recording.
+# GET /movies/:movie_id/comments is followed with slice_id so a request only returns the comments newer than the
+# last one that was written, when more came in than fit in one page the rest is read backwards with offset
+class CommentRecording:
+    def __init__(self, archiver, user_id, live_id, path):
+        self.archiver = archiver
+        self.user_id = user_id
+        self.live_id = str(live_id)
+        self.path = path
+        self.stop_event = asyncio.Event()
+        self.seen = OrderedDict()
+        self.last_id = None
+        self.count = 0
+
+    def stop(self):
+        self.stop_event.set()
+
+    def is_duplicate(self, comment_id):
+        if comment_id in self.seen:
+            return True
+        self.seen[comment_id] = True
+        if len(self.seen) > self.archiver.max_seen:
+            self.seen.popitem(last=False)
+        return False
+
+    def _remember(self, comment_id):
+        self.is_duplicate(comment_id)
+        if self.last_id is None or int(comment_id) > int(self.last_id):
+            self.last_id = comment_id
+
+    # Picks up where a previous run stopped when the program restarts during the live
+    def _resume(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "rb") as comments_file:
+                reader = zstd.ZstdDecompressor().stream_reader(comments_file, read_across_frames=True)
+                pending = b""
+                for chunk in iter(lambda: reader.read(65536), b""):
+                    *lines, pending = (pending + chunk).split(b"\n")
+                    for line in lines:
+                        self._remember(str(json.loads(line)['id']))
+        except (zstd.ZstdError, ValueError, KeyError, OSError) as error:
+            # A file cut off by a crash still has every comment before the cut
+            self.archiver.logger.debug(f"Stopped reading {self.path} at a damaged part: {error!r}")
+
+    async def _page(self, params):
+        await self.archiver.pace()
+        try:
+            status, res = await self.archiver.poller.request(f"{endpoints.API_URL}/movies/{self.live_id}/comments",
+                                                             headers=self.archiver.headers(), params=params,
+                                                             timeout=15)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            return repr(error), None
+        if status != 200 or not isinstance(res, dict):
+            return status, None
+        return status, [comment for comment in res.get('comments') or [] if 'id' in comment]
+
+    # Every comment after last_id, None when a request failed. slice_id only returns the newest page of them
+    # so when that page is full it is the first page and the ones before it are read(newest first) with offset
+    # until one reaches last_id. Comments that came in between two pages only make the next page overlap
+    async def _fetch(self):
+        limit = 50
+        found = {}
+        offset = 0
+        if self.last_id is not None:
+            status, comments = await self._page({'limit': limit, 'slice_id': self.last_id})
+            if comments is None or len(comments) < limit:
+                return status, comments
+            found = {str(comment['id']): comment for comment in comments}
+            offset = limit
+        while True:
+            status, comments = await self._page({'limit': limit, 'offset': offset})
+            if comments is None:
+                # last_id didn't move so the whole gap is read again next time
+                return status, None
+            for comment in comments:
+                if self.last_id is None or int(comment['id']) > int(self.last_id):
+                    found[str(comment['id'])] = comment
+            if len(comments) < limit or \
+                    any(self.last_id is not None and int(comment['id']) <= int(self.last_id) for comment in comments):
+                return status, list(found.values())
+            offset += limit
+            if self.last_id is None and offset >= self.archiver.max_backfill:
+                self.archiver.logger.info(f"Only archiving the newest {len(found)} comments of {self.live_id} "
+                                          f"that were written before the archiving started")
+                return status, list(found.values())
+
+    async def _wait(self, seconds):
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        archiver = self.archiver
+        logger = archiver.logger
+        self._resume()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        interval = archiver.interval
+        last_flush = time.monotonic()
+        # Appending starts a new zstd frame, readers decompress concatenated frames as one stream
+        with open(self.path, "ab", buffering=archiver.buffer_size) as comments_file:
+            # Each recording needs its own compressor, one can't be shared by streams written at the same time
+            writer = zstd.ZstdCompressor(level=archiver.level).stream_writer(comments_file)
+            try:
+                while True:
+                    # One more request after the live ended for the comments that came in since the last one
+                    stopping = self.stop_event.is_set()
+                    status, comments = await self._fetch()
+                    if status in (403, 404):
+                        logger.debug(f"Comments of {self.live_id} are not available ({status})")
+                        break
+                    if comments is not None:
+                        comments = sorted(comments, key=lambda comment: int(comment['id']))
+                        comments = [comment for comment in comments if not self.is_duplicate(str(comment['id']))]
+                    else:
+                        comments = []
+                        logger.debug(f"Fetching the comments of {self.live_id} failed ({status})")
+                    if comments:
+                        writer.write("".join(json.dumps(comment, ensure_ascii=False, separators=(",", ":")) + "\n"
+                                             for comment in comments).encode("utf-8"))
+                        self.last_id = str(comments[-1]['id'])
+                        self.count += len(comments)
+                        metrics.inc('comments_archived_total', len(comments))
+                    if time.monotonic() - last_flush > archiver.flush_interval:
+                        # Ends the current block so everything written so far can be read back after a crash
+                        writer.flush(zstd.FLUSH_BLOCK)
+                        last_flush = time.monotonic()
+                    if stopping:
+                        break
+                    # Quiet lives are checked less and less often, busy ones as often as the budget allows
+                    if len(comments) >= 50:
+                        interval = 0
+                    elif comments:
+                        interval = archiver.interval
+                    else:
+                        interval = min(archiver.max_interval, max(archiver.interval, interval * 1.5))
+                    await self._wait(interval)
+            finally:
+                writer.flush(zstd.FLUSH_FRAME)
+        logger.debug(f"Archived {self.count} comments of {self.live_id} to {self.path}")
+        return self.count
+
+
+# Runs one CommentRecording per live on the shared event loop. Together the recordings stay under budget
+# requests per minute(every page counts) so the comments don't use up the api rate limit the live checks need
+class CommentArchiver:
+    def __init__(self, logger, poller, headers, interval=5, max_interval=30, budget=30, level=3,
+                 buffer_size=65536, flush_interval=30, max_seen=4096, max_backfill=5000):
+        self.logger = logger
+        self.poller = poller
+        self.headers = headers
+        self.interval = interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.level = level
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_seen = max_seen
+        # Comments written before the archiving started that are still fetched
+        self.max_backfill = max_backfill
+        self.recordings = {}
+        self.tasks = set()
+        # When the next request of any recording may be sent
+        self.next_request = 0
+        metrics.gauge('comment_recordings_active', lambda: len(self.recordings))
+
+    # Waits for the next free request slot, the slots are handed out in the order they were asked for
+    async def pace(self):
+        if not self.budget:
+            return
+        now = time.monotonic()
+        slot = max(now, self.next_request)
+        self.next_request = slot + 60 / self.budget
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    @staticmethod
+    def path_for(video_path):
+        return f"{os.path.splitext(video_path)[0]}.comments.ndjson.zst"
+
+    def start(self, user_id, live_id, video_path):
+        current = self.recordings.get(user_id)
+        if current is not None:
+            if current.live_id == str(live_id):
+                return current
+            current.stop()
+        recording = CommentRecording(self, user_id, live_id, self.path_for(video_path))
+        self.recordings[user_id] = recording
+        task = asyncio.get_running_loop().create_task(self._run(recording))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return recording
+
+    async def _run(self, recording):
+        try:
+            await recording.run()
+        except Exception as e:
+            self.logger.error(f"Archiving the comments of {recording.live_id} failed: {e!r}", exc_info=True)
+        finally:
+            if self.recordings.get(recording.user_id) is recording:
+                del self.recordings[recording.user_id]
+
+    def stop(self, user_id):
+        recording = self.recordings.get(user_id)
+        if recording is not None:
+            recording.stop()
+
+    async def close(self, timeout=None):
+        for recording in list(self.recordings.values()):
+            recording.stop()
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+        for task in self.tasks:
+            task.cancel()
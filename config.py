@@ -0,0 +1,78 @@
+import asyncio
+import importlib
+import os
+from pathlib import Path
+
+
+# Keeps the settings from const.py and the password list in memory and reloads them when their files change,
+# so users can be added or removed while the program keeps running
+class ConfigStore:
+    def __init__(self, logger, module, on_change=None):
+        self.logger = logger
+        self.module = module
+        self.on_change = on_change
+        self.user_ids = list(dict.fromkeys(module.user_ids))
+        self.passwords = None
+        self.password_path = None
+        self.mtimes = {}
+        self._mtime(self.module.__file__)
+        self.load_passwords()
+
+    def get(self, name, default=None):
+        return getattr(self.module, name, default)
+
+    def _mtime(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (OSError, TypeError):
+            mtime = None
+        changed = self.mtimes.get(path) != mtime
+        self.mtimes[path] = mtime
+        return changed
+
+    def load_passwords(self):
+        try:
+            password_path = self.get('PASSWORD_PATH')
+            if password_path is None or password_path == "":
+                self.password_path = None
+                self.passwords = None
+                return
+            self.password_path = Path(password_path).resolve()
+            with open(self.password_path, mode='r', encoding="utf-8") as password_file:
+                # Keep the order of the file so the first passwords are tried first
+                self.passwords = list(dict.fromkeys(line.strip() for line in password_file if line.strip()))
+            self._mtime(self.password_path)
+        except Exception as e:
+            self.logger.error(e)
+            self.logger.error("Error getting password list")
+            self.passwords = None
+
+    def reload_module(self):
+        try:
+            self.module = importlib.reload(self.module)
+        except Exception as e:
+            self.logger.error(f"Could not reload {self.module.__file__}, keeping the previous settings: {e}")
+            return
+        user_ids = list(dict.fromkeys(self.module.user_ids))
+        added = [user_id for user_id in user_ids if user_id not in self.user_ids]
+        removed = [user_id for user_id in self.user_ids if user_id not in user_ids]
+        self.user_ids = user_ids
+        self.logger.info(f"Reloaded settings, {len(added)} user(s) added and {len(removed)} user(s) removed")
+        self.load_passwords()
+        if self.on_change is not None:
+            self.on_change(added, removed)
+
+    def refresh(self):
+        if self._mtime(self.module.__file__):
+            self.reload_module()
+        elif self.password_path is not None and self._mtime(self.password_path):
+            self.logger.info("Reloaded password list")
+            self.load_passwords()
+
+    async def watch(self, interval=5):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.error(e, exc_info=True)
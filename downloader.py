@@ -0,0 +1,429 @@
+import asyncio
+import os
+import shutil
+import time
+from collections import deque
+from metrics import metrics
+from recorder import RecorderUnavailable
+
+
+def restart_path(output, attempt):
+    root, ext = os.path.splitext(output)
+    return f"{root} (restart {attempt}){ext}"
+
+
+class DownloadJob:
+    def __init__(self, user_id, live_id, args, output, recording=None):
+        self.user_id = user_id
+        self.live_id = str(live_id)
+        self.args = args
+        self.output = output
+        # Built-in recorder that is tried before running args, see recorder.py
+        self.recording = recording
+        # Where the recording is moved once it ends, set when the live's title is known after the download started
+        self.rename_to = None
+        self.cancelled = False
+        # Stopped by close() before the live ended, the rest of the live still has to be recorded
+        self.interrupted = False
+        self.submitted = time.time()
+        self.status = "queued"
+        self.attempts = 0
+        self.returncode = None
+        self.process = None
+        self.task = None
+        self.started = None
+        self.ended = None
+        self.stderr = deque(maxlen=20)
+        self.warm_output = None
+
+    @property
+    def name(self):
+        return f"{self.user_id} {self.live_id}"
+
+
+# Owns the yt-dlp/streamlink child processes, caps how many run at once overall and per disk,
+# logs their exit code and stderr and restarts a download that died while the stream is still live
+class DownloadManager:
+    def __init__(self, logger, is_live=None, max_concurrent=10, max_per_disk=4, max_restarts=3, restart_delay=5,
+                 pool=None):
+        self.logger = logger
+        self.pool = pool
+        self.is_live = is_live
+        self.max_per_disk = max_per_disk
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.disk_semaphores = {}
+        # Queued and running downloads, a job is removed once it ended
+        self.jobs = {}
+        # Downloads stopped by close() before their live ended
+        self.interrupted = []
+        # Set by close(stop=True), queued downloads don't start anymore
+        self.stopping = False
+        # Called whenever a download starts or ends
+        self.on_change = None
+        # Called with the job once it ended and the files have their final names
+        self.on_finish = None
+        metrics.gauge('downloads_active', lambda: len(self.active()))
+        metrics.gauge('downloads_queued', lambda: len(self.queued()))
+        metrics.gauge('download_bytes', self.bytes_written)
+
+    # Downloads on the same device share a semaphore, the output folder might not exist yet so use its closest parent
+    def disk_key(self, output):
+        path = os.path.dirname(os.path.abspath(output))
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            return path
+
+    # Number of recordings running on the same disk as path
+    def disk_busy(self, path):
+        key = self.disk_key(path)
+        return sum(self.disk_key(job.output) == key for job in self.active())
+
+    def disk_semaphore(self, output):
+        key = self.disk_key(output)
+        if key not in self.disk_semaphores:
+            self.disk_semaphores[key] = asyncio.Semaphore(self.max_per_disk)
+        return self.disk_semaphores[key]
+
+    def submit(self, user_id, live_id, args, output, recording=None):
+        job = DownloadJob(user_id, live_id, args, output, recording)
+        # Running the exact same command twice would only write to the same file twice
+        key = tuple(args)
+        existing = self.jobs.get(key)
+        if existing is not None and existing.status in ("queued", "running"):
+            return existing
+        self.jobs[key] = job
+        job.task = asyncio.get_running_loop().create_task(self._run(job))
+        return job
+
+    def start(self):
+        if self.pool is not None:
+            self.pool.refill()
+
+    # Stops a download that turned out to be the wrong one, e.g. it was started before the live was known to be protected
+    def cancel(self, job):
+        job.cancelled = True
+        if job.recording is not None:
+            job.recording.stop()
+        if job.process is not None and job.process.returncode is None:
+            job.process.terminate()
+
+    # Gives the recording its final name, it is renamed once the download ends so a running process isn't disturbed
+    def rename(self, job, output):
+        if output == job.output:
+            return
+        job.rename_to = output
+        if job.status not in ("queued", "running"):
+            self._finalize(job)
+
+    def _rename_paths(self, job, rename_to):
+        paths = [(job.output, rename_to)]
+        for attempt in range(1, job.attempts + 1):
+            paths.append((restart_path(job.output, attempt), restart_path(rename_to, attempt)))
+        if job.recording is not None and job.recording.path:
+            # The raw recording is left behind when remuxing failed
+            paths.append((job.recording.path, os.path.splitext(rename_to)[0] + os.path.splitext(job.recording.path)[1]))
+        return [(source, dest) for source, dest in paths if os.path.exists(source)]
+
+    def _finalize(self, job):
+        if job.rename_to is None:
+            return
+        # Never move onto a file that is already there, the name gets a number instead
+        rename_to = job.rename_to
+        number = 0
+        paths = self._rename_paths(job, rename_to)
+        while any(os.path.exists(dest) for source, dest in paths):
+            number += 1
+            root, ext = os.path.splitext(job.rename_to)
+            rename_to = f"{root} ({number}){ext}"
+            paths = self._rename_paths(job, rename_to)
+        job.rename_to = rename_to
+        for source, dest in paths:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+                shutil.move(source, dest)
+            except OSError as osError:
+                self.logger.error(f"Could not rename {source} to {dest}: {osError}")
+        job.output = job.rename_to
+        job.rename_to = None
+
+    def active(self):
+        return [job for job in self.jobs.values() if job.status == "running"]
+
+    def queued(self):
+        return [job for job in self.jobs.values() if job.status == "queued"]
+
+    # Size on disk of the recordings that are running, the output of a restart is counted too
+    def bytes_written(self):
+        total = 0
+        for job in self.active():
+            if job.recording is not None:
+                total += job.recording.bytes
+                continue
+            paths = self.outputs(job)
+            if job.warm_output is not None:
+                paths.append(job.warm_output)
+            for path in paths:
+                try:
+                    total += os.path.getsize(path)
+                except OSError:
+                    pass
+        return total
+
+    # A restarted download can't reuse the same file name since yt-dlp would skip it as already downloaded
+    # Every file the job wrote, a restarted download writes to a new file
+    def outputs(self, job):
+        return [job.output, *(self.restart_output(job, attempt) for attempt in range(1, job.attempts + 1))]
+
+    def restart_output(self, job, attempt=None):
+        return restart_path(job.output, job.attempts if attempt is None else attempt)
+
+    def _changed(self):
+        if self.on_change is not None:
+            try:
+                self.on_change()
+            except Exception as e:
+                self.logger.debug(e, exc_info=True)
+
+    async def _run(self, job):
+        try:
+            return await self._attempts(job)
+        finally:
+            key = tuple(job.args)
+            if self.jobs.get(key) is job:
+                del self.jobs[key]
+            if job.interrupted:
+                self.interrupted.append(job)
+            self._finalize(job)
+            if self.on_finish is not None and job.status in ("finished", "failed"):
+                try:
+                    self.on_finish(job)
+                except Exception as e:
+                    self.logger.error(e, exc_info=True)
+
+    async def _attempts(self, job):
+        async with self.semaphore, self.disk_semaphore(job.output):
+            args = job.args
+            output = job.output
+            while not job.cancelled:
+                if self.stopping:
+                    # Still queued when the shutdown began, it is downloaded after the restart
+                    job.interrupted = True
+                    break
+                job.status = "running"
+                self._changed()
+                job.started = time.time()
+                if job.recording is not None:
+                    job.returncode = await self._record(job, args, output)
+                else:
+                    job.returncode = await self._spawn(job, args)
+                job.ended = time.time()
+                if job.cancelled:
+                    break
+                metrics.inc('downloads_total', result="finished" if job.returncode == 0 else "failed")
+                if job.returncode == 0:
+                    job.status = "finished"
+                    self._changed()
+                    self.logger.info(f"Finished downloading {job.name} in {job.ended - job.started:.0f}s")
+                    return job
+                self.logger.error(f"Download of {job.name} exited with code {job.returncode}")
+                for line in job.stderr:
+                    self.logger.error(f"{job.name}: {line}")
+                if job.returncode is None or job.attempts >= self.max_restarts or self.is_live is None \
+                        or not self.is_live(job.user_id, job.live_id):
+                    job.status = "failed"
+                    self._changed()
+                    return job
+                job.attempts += 1
+                self.logger.info(f"{job.user_id} is still live, restarting download ({job.attempts}/{self.max_restarts})")
+                await asyncio.sleep(self.restart_delay)
+                output = self.restart_output(job)
+                args = [output if arg == job.output else arg for arg in job.args]
+                if job.recording is not None:
+                    job.recording = job.recording.recorder.recording(job.recording.user_id)
+            job.status = "cancelled"
+            self._changed()
+            self.logger.debug(f"Cancelled the download of {job.name}")
+            return job
+
+    # Falls back to running args when the stream can't be recorded natively
+    async def _record(self, job, args, output):
+        try:
+            return await job.recording.run(output)
+        except RecorderUnavailable as error:
+            self.logger.info(f"Recording {job.name} with {args[0]} instead: {error}")
+        except OSError as osError:
+            self.logger.error(f"Recording {job.name} failed: {osError}")
+            job.stderr.append(str(osError))
+            return None
+        job.recording = None
+        return await self._spawn(job, args)
+
+    async def _spawn(self, job, args):
+        job.process = None
+        # The warm workers write on the disk of the pool folder, a recording that goes to another disk would have
+        # to be copied over afterwards and wouldn't count against that disk's limit
+        if job.attempts == 0 and self.pool is not None and \
+                self.disk_key(os.path.join(self.pool.directory, "warm")) == self.disk_key(job.output):
+            job.process, job.warm_output = self.pool.take(args)
+        if job.process is None:
+            if self.stopping:
+                return None
+            self.logger.debug(f"Running {args}")
+            try:
+                job.process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                                   stderr=asyncio.subprocess.PIPE)
+            except OSError as osError:
+                self.logger.error(f"Could not start {args[0]}: {osError}")
+                job.stderr.append(str(osError))
+                return None
+            except NotImplementedError:
+                # Event loops without subprocess support, e.g. the selector loop on Windows
+                self.logger.error(f"Could not start {args[0]}: the {type(asyncio.get_running_loop()).__name__} "
+                                  f"can't run subprocesses")
+                job.stderr.append("event loop without subprocess support")
+                return None
+        metrics.observe('download_start_seconds', time.time() - job.submitted)
+        job.stderr.clear()
+        # yt-dlp writes warnings and errors to stderr, progress goes to stdout which is discarded
+        async for line in job.process.stderr:
+            line = line.decode("utf-8", errors="replace").rstrip()
+            if line:
+                job.stderr.append(line)
+                self.logger.debug(f"{job.name}: {line}")
+        returncode = await job.process.wait()
+        if job.warm_output is not None:
+            # A warm worker writes to its own file inside the pool folder
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._move_warm, job.warm_output, job.output)
+            except OSError as osError:
+                self.logger.error(f"Could not move {job.warm_output} to {job.output}: {osError}")
+            job.warm_output = None
+        return returncode
+
+    @staticmethod
+    def _move_warm(warm_output, output):
+        if not os.path.exists(warm_output):
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        if os.path.exists(output):
+            raise FileExistsError(f"{output} already exists")
+        shutil.move(warm_output, output)
+
+    # Either wait for the running downloads to finish or terminate them
+    async def close(self, stop=True, timeout=10):
+        if self.pool is not None:
+            await self.pool.close()
+        tasks = [job.task for job in self.jobs.values() if job.task is not None and not job.task.done()]
+        if not tasks:
+            return
+        if stop:
+            self.stopping = True
+            for job in self.jobs.values():
+                if job.status in ("queued", "running"):
+                    job.interrupted = True
+                if job.recording is not None:
+                    job.recording.stop()
+                if job.process is not None and job.process.returncode is None:
+                    job.process.terminate()
+            # Make sure stopped downloads are not restarted while shutting down
+            self.is_live = None
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if stop:
+            killed = [job.process for job in self.jobs.values()
+                      if job.process is not None and job.process.returncode is None]
+            for process in killed:
+                process.kill()
+            # Reap them while the loop that watches the child processes is still running
+            if killed:
+                await asyncio.wait([asyncio.ensure_future(process.wait()) for process in killed], timeout=5)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending, timeout=5)
+
+
+# yt-dlp processes that are already started and have imported everything, waiting for a url on stdin(-a -),
+# so a download starts without paying for the interpreter start up. Only used for downloads run with exactly
+# args + ['-o', output, url] whose output is on the same disk as directory, each worker writes to its own file in
+# directory which is moved to output afterwards
+class WarmPool:
+    def __init__(self, logger, args, directory, size=2):
+        self.logger = logger
+        self.args = list(args)
+        self.directory = directory
+        self.size = size
+        self.idle = deque()
+        self.spawned = 0
+        self.filling = None
+
+    def matches(self, args):
+        return len(args) == len(self.args) + 3 and args[:len(self.args)] == self.args and args[-3] == '-o'
+
+    async def _spawn(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.spawned += 1
+        output = os.path.join(self.directory, f"warm-{os.getpid()}-{self.spawned}.mp4")
+        process = await asyncio.create_subprocess_exec(*self.args, '-o', output, '-a', '-',
+                                                       stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.PIPE)
+        return process, output
+
+    async def _fill(self):
+        try:
+            while len(self.idle) < self.size:
+                self.idle.append(await self._spawn())
+        except (OSError, NotImplementedError) as error:
+            self.logger.error(f"Could not start a warm {self.args[0]} worker: {error!r}")
+
+    def refill(self):
+        if self.size and (self.filling is None or self.filling.done()):
+            self.filling = asyncio.get_running_loop().create_task(self._fill())
+
+    # Hands the url to a waiting worker, returns (None, None) when none is ready
+    def take(self, args):
+        if not self.matches(args):
+            return None, None
+        while self.idle:
+            process, output = self.idle.popleft()
+            if process.returncode is not None:
+                continue
+            process.stdin.write(f"{args[-1]}\n".encode())
+            process.stdin.close()
+            self.refill()
+            self.logger.debug(f"Running {args} on a warm worker")
+            return process, output
+        self.refill()
+        return None, None
+
+    # The workers were started with the old cookies so they are replaced
+    def set_args(self, args):
+        args = list(args)
+        if args == self.args:
+            return
+        self.args = args
+        if self.filling is not None:
+            self.filling.cancel()
+            self.filling = None
+        self._stop_idle()
+        self.refill()
+
+    def _stop_idle(self):
+        while self.idle:
+            process, output = self.idle.popleft()
+            if process.returncode is None:
+                process.kill()
+
+    async def close(self):
+        if self.filling is not None:
+            self.filling.cancel()
+        processes = [process for process, output in self.idle]
+        self._stop_idle()
+        for process in processes:
+            await process.wait()
@@ -0,0 +1,12 @@
+# Base urls of the twitcasting endpoints that are polled, they are only changed to point at a local mock server
+# (see bench/) and are read on every request so configure() applies immediately
+API_URL = "https://apiv2.twitcasting.tv"
+FRONTEND_API_URL = "https://frontendapi.twitcasting.tv"
+SITE_URL = "https://twitcasting.tv"
+
+
+def configure(api_url=None, frontend_api_url=None, site_url=None):
+    global API_URL, FRONTEND_API_URL, SITE_URL
+    API_URL = (api_url or API_URL).rstrip("/")
+    FRONTEND_API_URL = (frontend_api_url or FRONTEND_API_URL).rstrip("/")
+    SITE_URL = (site_url or SITE_URL).rstrip("/")
@@ -0,0 +1,148 @@
+import codecs
+from html.parser import HTMLParser
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+
+class MemberPageError(ValueError):
+    pass
+
+
+def build_member_data(user_id, icon_src, title, subtitle, title_icons, image, thumbnail, date_title):
+    if icon_src is None or image is None or thumbnail is None or date_title is None:
+        raise MemberPageError(f"{user_id} show page is missing the latest movie or the user icon")
+    title = title.strip() if title is not None else user_id
+    subtitle = subtitle.strip() if subtitle is not None else title
+    member_data = {'title': title, 'subtitle': subtitle, 'is_protected': title_icons > 1,
+                   'date': date_title[:10].replace("/", ""), 'image': f'https:{image}', 'thumbnail': thumbnail}
+    return "member" in icon_src, member_data
+
+
+# Streaming parser for the /show/ page that only looks at the user icon and the first recorded movie
+# and stops as soon as both have been seen instead of building a tree of the whole page
+class MemberPageExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.depth = 0
+        self.done = False
+        self.nav_depth = None
+        self.box_depth = None
+        self.anchor_depth = None
+        self.anchor_done = False
+        self.title_depth = None
+        self.label_depth = None
+        self.icon_src = None
+        self.title_icons = 0
+        self.title = None
+        self.subtitle = None
+        self.image = None
+        self.thumbnail = None
+        self.date_title = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or "").split()
+        if tag == 'div' and 'tw-user-nav2-icon' in classes and self.image is None and self.nav_depth is None:
+            self.nav_depth = self.depth
+        elif tag == 'img' and self.nav_depth is not None and self.depth == self.nav_depth + 1 and self.image is None:
+            self.image = attrs.get('src')
+        if tag == 'div' and 'recorded-movie-box' in classes and self.box_depth is None and not self.anchor_done:
+            self.box_depth = self.depth
+        elif tag == 'a' and 'tw-movie-thumbnail2' in classes and self.box_depth is not None \
+                and self.anchor_depth is None and not self.anchor_done:
+            self.anchor_depth = self.depth
+        elif self.anchor_depth is not None:
+            if tag == 'span' and 'tw-movie-thumbnail2-title' in classes and self.title is None:
+                self.title_depth = self.depth
+                self.title = ""
+            elif tag == 'span' and 'tw-movie-thumbnail2-label' in classes and self.subtitle is None:
+                self.label_depth = self.depth
+                self.subtitle = ""
+            elif tag == 'img' and 'tw-movie-thumbnail2-title-icon' in classes:
+                if self.icon_src is None:
+                    self.icon_src = attrs.get('src')
+                if self.title_depth is not None:
+                    self.title_icons += 1
+            elif tag == 'img' and 'tw-movie-thumbnail2-image' in classes and self.thumbnail is None:
+                self.thumbnail = attrs.get('src')
+                self.date_title = attrs.get('title')
+        if tag not in VOID_ELEMENTS:
+            self.depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.done or tag in VOID_ELEMENTS:
+            return
+        self.depth = max(0, self.depth - 1)
+        if self.title_depth is not None and self.depth <= self.title_depth:
+            self.title_depth = None
+        if self.label_depth is not None and self.depth <= self.label_depth:
+            self.label_depth = None
+        if self.anchor_depth is not None and self.depth <= self.anchor_depth:
+            self.anchor_depth = None
+            self.anchor_done = True
+        if self.box_depth is not None and self.depth <= self.box_depth:
+            self.box_depth = None
+        if self.nav_depth is not None and self.depth <= self.nav_depth:
+            self.nav_depth = None
+        self.done = self.anchor_done and self.image is not None
+
+    def handle_data(self, data):
+        if self.title_depth is not None:
+            self.title += data
+        if self.label_depth is not None:
+            self.subtitle += data
+
+    # Feed raw bytes as they arrive, returns True once everything needed has been found
+    def feed_bytes(self, chunk, final=False):
+        if not self.done:
+            self.feed(self.decoder.decode(chunk, final))
+        return self.done
+
+    def result(self, user_id):
+        return build_member_data(user_id, self.icon_src, self.title, self.subtitle, self.title_icons,
+                                 self.image, self.thumbnail, self.date_title)
+
+
+def extract_member_page_lexbor(user_id, page_res):
+    tree = LexborHTMLParser(page_res)
+    anchor = tree.css_first("div.recorded-movie-box a.tw-movie-thumbnail2")
+    nav_icon = tree.css_first("div.tw-user-nav2-icon > img")
+    if anchor is None or nav_icon is None:
+        raise MemberPageError(f"{user_id} show page is missing the latest movie or the user icon")
+    icon = anchor.css_first("img.tw-movie-thumbnail2-title-icon")
+    title = anchor.css_first("span.tw-movie-thumbnail2-title")
+    label = anchor.css_first("span.tw-movie-thumbnail2-label")
+    thumbnail = anchor.css_first("img.tw-movie-thumbnail2-image")
+    return build_member_data(user_id,
+                             icon.attributes.get('src') if icon is not None else None,
+                             title.text() if title is not None else None,
+                             label.text() if label is not None else None,
+                             len(title.css("img.tw-movie-thumbnail2-title-icon")) if title is not None else 0,
+                             nav_icon.attributes.get('src'),
+                             thumbnail.attributes.get('src') if thumbnail is not None else None,
+                             thumbnail.attributes.get('title') if thumbnail is not None else None)
+
+
+def extract_member_page(user_id, page_res, backend="stream"):
+    if backend == "lexbor" and LexborHTMLParser is not None:
+        return extract_member_page_lexbor(user_id, page_res)
+    extractor = MemberPageExtractor()
+    for start in range(0, len(page_res), 16384):
+        extractor.feed(page_res[start:start + 16384])
+        if extractor.done:
+            break
+    return extractor.result(user_id)
@@ -1,17 +1,35 @@
+import argparse
 import asyncio
 import json
 import os
-import subprocess
-import threading
+import sys
 import time
 from datetime import datetime, timezone
 import aiohttp
-import requests
 from pathlib import Path
-from bs4 import BeautifulSoup
-from requests.adapters import HTTPAdapter
 import const
+import endpoints
+from bulk import BulkDetector
+from cache import MetadataCache
+from comments import CommentArchiver
+from config import ConfigStore
+from downloader import DownloadManager, WarmPool
+from extract import MemberPageError, MemberPageExtractor, extract_member_page
 from log import create_logger
+from metrics import metrics
+from passwords import PasswordProber
+from notifier import WebhookNotifier
+from poller import LivePoller
+from postprocess import DEFAULT_STEPS, PostProcessor
+from push import PushReceiver
+from ratelimit import RateLimiter
+from recorder import HLSRecorder
+from scheduler import PollScheduler
+from service import EXIT_ERROR, EXIT_OK, EXIT_USAGE, Service
+from shard import ClaimStore, Shard
+from state import StateStore
+from storage import Storage
+from status import StatusDisplay
 import base64
 
 
@@ -20,30 +38,6 @@ CLIENT_SECRET = const.CLIENT_SECRET
 ACCESS_TOKEN = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode("utf-8")
 
 
-def check_file(live_date, live_title, live_id, streamer, output_path):
-    file_name = f'{live_date} - {live_title} ({live_id}).mp4'
-    try:
-        if os.path.isfile(f'{output_path}\\{streamer}\\{file_name}'):
-            live_date = f'{live_date}{str(time.strftime("%H%M%S"))}'
-        file_name = f'{live_date} - {live_title} ({live_id}).mp4'
-    except Exception as e:
-        logger.debug(e)
-    finally:
-        return file_name
-
-
-def loading_text():
-    loading_string = "Waiting for live twitcasting streams "
-    animation = ["     ", ".    ", "..   ", "...  ", ".... ", "....."]
-    idx = 0
-    while True:
-        print(f"[INFO] {datetime.now().replace(microsecond=0)} | " + loading_string + animation[idx % len(animation)], end="\r")
-        time.sleep(0.3)
-        idx += 1
-        if idx == 6:
-            idx = 0
-
-
 def format_url_message(user_id, live_id, live_message, live_url):
     live_message = live_message.replace("protected", "`protected`").replace("member's only", "`member's only`")
     if "_" in user_id[0] or "_" in user_id[-1] or "__" in user_id:
@@ -71,97 +65,96 @@ def get_secondary_title(res):
 
 
 def get_passwords():
-    try:
-        if PASSWORD_PATH is None or PASSWORD_PATH == "":
-            return None
-        with open(PASSWORD_PATH, mode='r', encoding="utf-8") as password_file:
-            lines = password_file.readlines()
-            passwords = {line.rstrip() for line in lines}
-        return passwords
-    except Exception as e:
-        logger.error(e)
-        logger.error("Error getting password list")
+    if config.passwords is None:
         return None
+    return list(config.passwords)
+
+
+def get_cookies(cookies):
+    if cookies is None:
+        return []
+    if '--cookies-from-browser' in cookies:
+        return cookies.split(maxsplit=1)
+    return ['--cookies', cookies]
+
+
+def get_output_paths(paths):
+    # OUTPUT_PATH can be one folder or a list of folders on different disks
+    if isinstance(paths, (list, tuple)):
+        return [Path(path).resolve() for path in paths if path] or [os.getcwd()]
+    if paths is not None and paths != "":
+        return [Path(paths).resolve()]
+    return [os.getcwd()]
+
+
+# Applies reloaded settings without touching the users that are live or their downloads
+def apply_config(added, removed):
+    global COOKIES, WEBHOOK_URL
+    for user_id in removed:
+        user_ids.pop(user_id, None)
+        scheduler.remove(user_id)
+        if comments is not None:
+            comments.stop(user_id)
+        logger.info(f"Stopped watching {user_id}")
+    for user_id in added:
+        if not shard.owns(user_id):
+            continue
+        user_ids[user_id] = {"movie_id": None, "notified": False, "downloaded": False, "type": None}
+        scheduler.add(user_id, delay=0)
+        logger.info(f"Started watching {user_id}")
+    COOKIES = get_cookies(config.get('COOKIES'))
+    prober.cookies = COOKIES
+    if config.get('WEBHOOK_URL') != WEBHOOK_URL:
+        WEBHOOK_URL = config.get('WEBHOOK_URL')
+        notifier.set_urls(WEBHOOK_URL)
+    storage.set_roots(get_output_paths(config.get('OUTPUT_PATH')))
+    if downloads.pool is not None:
+        downloads.pool.set_args(download_args())
 
 
-# This endpoint can catch membership streams but may rate limit after a while
-async def fetch_html(session, user_id):
-    headers = {'Accept': 'application/json'}
-    url = f"https://twitcasting.tv/streamserver.php?target={user_id}&mode=client"
-    res = await session.get(url, headers=headers)
-    return res, user_id
-
-
-async def get_lives():
-    tasks = []
-    live_streams = []
-    rate_limit = False
-    async with aiohttp.ClientSession() as session:
-        for user_id in user_ids:
-            tasks.append(fetch_html(session, user_id))
-        results = await asyncio.gather(*tasks)
-    for result in results:
-        try:
-            res = await result[0].json(content_type=None)
-        except json.JSONDecodeError as jsonDecodeError:
-            logger.debug(jsonDecodeError)
-            logger.debug(result)
-            logger.debug(f"Error {result[0].status}: {result[0].reason}")
-            rate_limit = True
-            res = {}
-            await asyncio.sleep(1)
-        except aiohttp.ClientError as clientError:
-            logger.debug(clientError)
-            logger.debug(result)
-            logger.debug(f"Error {result[0].status}: {result[0].reason}")
-            rate_limit = True
-            res = {}
-            await asyncio.sleep(1)
-        id = result[1]
-        if not res:
-            res = {'error': True}
-
-        live_streams.append((res, id))
-    if rate_limit:
-        #     TODO maybe switch api instead
-        time.sleep(5)
-    return live_streams
+def download_args():
+    return ['yt-dlp', *COOKIES, '--no-part', '--embed-metadata', '-N', '4']
+
+
+def api_headers():
+    return {'Authorization': f'Basic {ACCESS_TOKEN}',
+            'Accept': 'application/json',
+            'X-Api-Version': '2.0'}
 
 
 # Used to check the latest movie to see if it's live and/or is a member's only stream
-def check_latest_live(user_id, session, logger):
+async def check_latest_live(user_id, poller, logger):
+    res = {}
     try:
-        headers = {'Authorization': f'Basic {ACCESS_TOKEN}',
-                   'Accept': 'application/json',
-                   'X-Api-Version': '2.0'}
-        response = session.get(f"https://apiv2.twitcasting.tv/users/{user_id}/movies?limit=1",
-                               headers=headers)
-        if response.status_code == 401:
+        headers = api_headers()
+        status, res = await cache.fetch(poller, ('movies', user_id),
+                                        f"{endpoints.API_URL}/users/{user_id}/movies?limit=1",
+                                        MOVIE_CACHE_TTL, headers=headers, timeout=REQUEST_TIMEOUT)
+        if status == 401:
             logger.error("Error with tokens")
-        res = response.json()
         logger.debug(res)
-        logger.debug(response.status_code)
+        logger.debug(status)
+        # If the stream is live then it's a member's only live stream
+        if len(res['movies']) == 0:
+            return {}
         try:
-            response = session.get(f"https://apiv2.twitcasting.tv/users/{user_id}", headers=headers).json()
-            if response.status_code == 401:
+            # Profiles barely change so they are cached for a long time and revalidated when they expire
+            status, user_res = await cache.fetch(poller, ('user', user_id), f"{endpoints.API_URL}/users/{user_id}",
+                                                 PROFILE_CACHE_TTL, headers=headers, timeout=REQUEST_TIMEOUT)
+            if status == 401:
                 logger.error("Error with tokens")
-            user_res = response.json()
-            # If the stream is live then it's a member's only live stream
-            if len(res['movies']) != 0:
-                res_data = {'movie': res['movies'][0], 'broadcaster': user_res['user']}
-                logger.debug(res_data)
-                return res_data
-            else:
-                return {}
-        except TypeError:
-            res_data = {'movie': data['movies'][0],
+            res_data = {'movie': res['movies'][0], 'broadcaster': user_res['user']}
+            logger.debug(res_data)
+            return res_data
+        except (TypeError, KeyError):
+            res_data = {'movie': res['movies'][0],
                         'broadcaster': {'screen_id': user_id, 'image': res['movies'][0]['large_thumbnail']}}
             return res_data
 
-    except requests.exceptions.ConnectionError as cError:
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as cError:
         logger.debug(cError)
         return {}
-    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError) as rerror:
+    except (aiohttp.ClientError, json.decoder.JSONDecodeError) as rerror:
         logger.error(rerror)
         return {}
     except Exception as e:
@@ -170,60 +163,48 @@ def check_latest_live(user_id, session, logger):
         return {}
 
 
-def poll_member_stream(user_id):
+async def poll_member_stream(user_id):
     membership_status = False
     member_data = {}
+    cache_key = ('member', user_id, str(user_ids[user_id]['movie_id']))
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    url = f"{endpoints.SITE_URL}/{user_id}/show/"
     try:
-        page_res = requests.get(f"https://twitcasting.tv/{user_id}/show/").text
-        soup = BeautifulSoup(page_res, "html.parser")
-        first_video_element = soup.find("div", class_="recorded-movie-box").find("a", class_="tw-movie-thumbnail2")
-        # sometimes tw-movie-thumbnail-title-icon does not exist if grabbed too early but no issues as it can repoll
-        # if is issue either give up or get tw-movie-thumbnail-image as a replacement but link can't be viewed probably
-        member_icon_element = first_video_element.find("img", class_="tw-movie-thumbnail2-title-icon")['src']
-        membership_status = True if "member" in member_icon_element else False
+        if MEMBER_PAGE_PARSER == "lexbor":
+            status, page_res = await poller.request(url, as_json=False, timeout=REQUEST_TIMEOUT)
+            membership_status, member_data = await asyncio.get_running_loop().run_in_executor(
+                None, extract_member_page, user_id, page_res, MEMBER_PAGE_PARSER)
+        else:
+            # Only the start of the page is downloaded and parsed, the request is dropped once the movie is found
+            extractor = MemberPageExtractor()
+            await poller.stream(url, extractor.feed_bytes, timeout=REQUEST_TIMEOUT)
+            membership_status, member_data = extractor.result(user_id)
         # If this endpoint returns False on is_on_live then it's likely a member only stream
         logger.debug(f"{user_id} member stream: {membership_status}")
-        movie_title_element = first_video_element.find("span", class_="tw-movie-thumbnail2-title")
-        if movie_title_element is not None:
-            movie_title = movie_title_element.text.strip()
-        else:
-            movie_title = user_id
-        movie_subtitle_element = first_video_element.find("span", class_="tw-movie-thumbnail2-label")
-        if movie_subtitle_element is not None:
-            movie_subtitle = first_video_element.find("span", class_="tw-movie-thumbnail2-label").text.lstrip().rstrip()
-        else:
-            movie_subtitle = movie_title
-        is_protected = True if len(first_video_element.find("span", class_="tw-movie-thumbnail2-title")
-                                   .find_all("img", class_="tw-movie-thumbnail2-title-icon")) > 1 else False
-        image = soup.find("div", class_="tw-user-nav2-icon").find("img", recursive=False)['src']
-        thumbnail = soup.find("img", class_="tw-movie-thumbnail2-image")['src']
-        date = first_video_element.find("img", class_="tw-movie-thumbnail2-image")['title'][:10].replace("/", "")
-        member_data = {'title': movie_title, 'subtitle': movie_subtitle, 'is_protected': is_protected, 'date': date,
-                       'image': f'https:{image}', 'thumbnail': thumbnail}
-    except KeyError as kError:
-        logger.debug(page_res)
-        logger.error(kError, exc_info=True)
-    except AttributeError as aError:
-        logger.debug(page_res)
-        logger.error(aError, exc_info=True)
+        # Only cache a complete answer, the page can be grabbed before the new movie shows up on it
+        if membership_status and member_data:
+            cache.put(cache_key, (membership_status, member_data), PROFILE_CACHE_TTL)
+    except MemberPageError as mError:
+        # sometimes tw-movie-thumbnail-title-icon does not exist if grabbed too early but no issues as it can repoll
+        logger.debug(mError)
     except Exception as e:
-        logger.debug(page_res)
         logger.error(e, exc_info=True)
-    finally:
-        return membership_status, member_data
+    return membership_status, member_data
 
 
-def check_member_stream(user_id):
+async def check_member_stream(user_id):
     headers = {'Accept': 'application/json'}
-    url = f"https://frontendapi.twitcasting.tv/users/{user_id}/latest-movie"
-    res = requests.get(url, headers=headers).json()
+    url = f"{endpoints.FRONTEND_API_URL}/users/{user_id}/latest-movie"
+    status, res = await poller.request(url, headers=headers, timeout=REQUEST_TIMEOUT)
     try:
         # If this endpoint returns False on is_on_live then it's likely a member only stream
         if not res['movie']['is_on_live']:
             return True
         else:
             return False
-    except KeyError as kError:
+    except (KeyError, TypeError) as kError:
         # If this endpoint contains any empty movie dictionary then it's likely a member only stream
         logger.debug(kError)
         return True
@@ -233,20 +214,31 @@ def add_live_users(lives):
     for stream in lives:
         stream_json = stream[0]
         streamer_name = stream[1]
+        # The user was removed from the settings while being polled
+        if streamer_name not in user_ids:
+            continue
 
         try:
             if len(stream_json) != 0 and stream_json['movie']['live']:
                 movie_id = stream_json['movie']['id']
-                if movie_id != user_ids[streamer_name]['movie_id']:
+                if str(movie_id) != str(user_ids[streamer_name]['movie_id']):
+                    # A live that was already seen keeps its flags so it isn't notified or downloaded twice
+                    saved = state.open_live(streamer_name, movie_id)
                     user_ids[streamer_name] = {"movie_id": movie_id,
-                                               "notified": False,
-                                               "downloaded": False,
+                                               "notified": saved['notified'],
+                                               "downloaded": saved['downloaded'],
                                                "type": "Live"}
+                    if PRESTART_DOWNLOADS and not saved['downloaded']:
+                        prestart_download(streamer_name, movie_id)
             else:
                 try:
                     if user_ids[streamer_name]["movie_id"] is not None and 'error' not in stream_json:
                         # logger.info(f"{streamer_name} is now offline{' ' * 25}\n")
-                        logger.info(f"{streamer_name} is now offline{' '*25}")
+                        logger.info(f"{streamer_name} is now offline")
+                        state.close_live(streamer_name, user_ids[streamer_name]["movie_id"])
+                        prestarted.pop((streamer_name, str(user_ids[streamer_name]["movie_id"])), None)
+                        if comments is not None:
+                            comments.stop(streamer_name)
                 except Exception as e:
                     logger.error(e)
                 user_ids[streamer_name] = {"movie_id": None,
@@ -261,235 +253,606 @@ def add_live_users(lives):
             continue
 
 
-if __name__ == "__main__":
-    logger = create_logger()
-    logger.info("Starting program")
+# Starts recording as soon as a new live is seen instead of after its details were fetched and the notification
+# was sent, the file gets a temporary name which is replaced by the usual one once handle_live() knows the title
+def prestart_download(user_id, movie_id):
+    if not claim('download', user_id, movie_id):
+        return
+    root = storage.place()
+    if root is None:
+        return
+    download_url = f"https://twitcasting.tv/{user_id}/movie/{movie_id}"
+    output = os.path.join(root, user_id, f'{time.strftime("%Y%m%d%H%M%S")} ({movie_id}).mp4')
+    logger.info(f"Downloading {download_url}")
+    # Always yt-dlp, it isn't known yet whether the live is member's only which the native recorder can't record
+    prestarted[(user_id, str(movie_id))] = downloads.submit(user_id, movie_id, [*download_args(), '-o', output,
+                                                                               download_url], output)
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as osError:
+            logger.error(f"Could not remove {path}: {osError}")
+
+
+# Stops a download that was started for nothing and deletes what it wrote once its process exited
+def discard_download(job):
+    def ended(_):
+        if job.status == "cancelled":
+            asyncio.get_running_loop().run_in_executor(None, remove_files, downloads.outputs(job))
+    downloads.cancel(job)
+    job.task.add_done_callback(ended)
+
+
+# A go-live or go-offline pushed by twitcasting, applied the same way as a poll result
+def on_push(movie, broadcaster):
+    names = {str(broadcaster.get('screen_id', '')).lower(), str(broadcaster.get('id', '')).lower()}
+    user_id = next((user_id for user_id in user_ids if str(user_id).lower() in names), None)
+    if user_id is None:
+        return
+    metrics.inc('push_events_total', event="livestart" if movie.get('is_live') else "liveend")
+    if movie.get('is_live'):
+        logger.debug(f"{user_id} went live according to a webhook")
+        cache.put(('user', user_id), {'user': broadcaster}, PROFILE_CACHE_TTL)
+        add_live_users([({'movie': {'id': movie['id'], 'live': True}}, user_id)])
+        scheduler.record(user_id, True)
+    # An old liveend arriving after the next live started must not end the new one
+    elif str(user_ids[user_id]['movie_id']) == str(movie['id']):
+        add_live_users([({'movie': {'id': movie['id'], 'live': False}}, user_id)])
+        scheduler.record(user_id, False)
+    # Notify and download now instead of after the main loop's sleep
+    service.wake()
+
+
+# Feed the poll results back into the scheduler so each user's next poll follows their streaming habits
+def schedule_next_polls(lives):
+    for stream_json, user_id in lives:
+        if user_id not in user_ids:
+            continue
+        if 'error' in stream_json:
+            scheduler.retry(user_id)
+        else:
+            scheduler.record(user_id, user_ids[user_id]['movie_id'] is not None)
 
-    # Setup
-    SLEEP_TIME = const.SLEEP_TIME
-    WEBHOOK_URL = const.WEBHOOK_URL
 
+# Resolves the details of a live stream that was just detected, every request in here is awaited on the shared
+# event loop so lives that start at the same time are resolved concurrently instead of one after another
+async def resolve_live(user_id):
+    res = {}
     try:
-        PASSWORD_PATH = Path(const.PASSWORD_PATH).resolve()
-    except Exception:
-        logger.error("There is a problem with the password path")
+        status, res = await poller.request(f"{endpoints.API_URL}/users/{user_id}/current_live",
+                                           headers=api_headers(), timeout=REQUEST_TIMEOUT)
+        if status == 401:
+            logger.error("Error with tokens")
+            return None
+        logger.debug(res)
+        if 'movie_id' in res and res['movie_id'] is not None:
+            # Check if it's a member's only stream
+            is_member = await check_member_stream(user_id)
+            logger.debug(is_member)
+            if is_member:
+                res['member_only'] = True
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as cError:
+        logger.error(cError)
+        return None
+    except (aiohttp.ClientError, json.decoder.JSONDecodeError) as rerror:
+        logger.error(rerror)
+        return None
+    # If the request could not be sent due to an invalid bearer token
+    if 'error' in res and res['error']['code'] == 1000:
+        logger.error("Invalid bearer token, check CLIENT_ID and CLIENT_SECRET")
+        service.request_stop(exit_code=EXIT_USAGE)
+        return None
+    # If res returns a json with an error key then it is not currently live
+    if 'error' in res and res['error']['code'] == 404:
+        res = await check_latest_live(user_id, poller, logger)
+        if res == {}:
+            member_res, data = await poll_member_stream(user_id)
+            # maybe also checking member_res is not necessary
+            if member_res and user_ids[user_id]["type"] == "Live":
+                # For now use live thumbnail instead of pfp
+                try:
+                    res = {'movie': {'id': user_ids[user_id]['movie_id'], 'title': data['title'],
+                                     'subtitle': data['subtitle'],
+                                     'last_owner_comment': None, 'is_protected': data['is_protected'],
+                                     'date': data['date'],
+                                     'member_thumbnail': data['thumbnail']},
+                           'broadcaster': {'screen_id': user_id,
+                                           'image': data['image']},
+                           'member_only': True}
+                    logger.debug(res)
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+                    return None
+            else:
+                return None
+        else:
+            res['member_only'] = True
+            res['movie']['member_thumbnail'] = res['movie']['small_thumbnail']
+    return parse_live(user_id, res)
 
-    logger.debug(f'Authorization: Basic {ACCESS_TOKEN}')
 
-    COOKIES = []
-    if const.COOKIES is not None:
-        if '--cookies-from-browser' in const.COOKIES:
-            COOKIES = const.COOKIES.split(maxsplit=1)
+def parse_live(user_id, res):
+    # TODO set default values in event not found
+    try:
+        member_only = res['member_only'] if 'member_only' in res else False
+        protected = res['movie']['is_protected'] if 'is_protected' in res['movie'] else False
+        live_id = res['movie']['id']
+        screen_id = res['broadcaster']['screen_id']
+        user_image = res['broadcaster']['image']
+        live_title = res['movie']['title']
+        live_comment = get_secondary_title(res)
+        if 'member_thumbnail' not in res['movie']:
+            if 'large_thumbnail' in res['movie']:
+                live_thumbnail = res['movie']['large_thumbnail']
+            else:
+                live_thumbnail = f"https://apiv2.twitcasting.tv/users/{user_id}/live/thumbnail?size=large&position=latest"
+        else:
+            live_thumbnail = res['movie']['member_thumbnail']
+        live_created = res['movie'].get('created')
+        if 'created' in res['movie']:
+            live_date = datetime.fromtimestamp(res['movie']['created']).strftime('%Y%m%d')
         else:
-            COOKIES = ['--cookies', const.COOKIES]
+            live_date = res['movie']['date']
+        if "_" not in screen_id[0] or "_" not in screen_id[-1]:
+            live_url = f"https://twitcasting.tv/{screen_id}/movie/{live_id}"
+        else:
+            live_url = f"`https://twitcasting.tv/{screen_id}/movie/{live_id}`"
+        download_url = f"https://twitcasting.tv/{screen_id}/movie/{live_id}"
+    except KeyError as kError:
+        logger.error(kError, exc_info=True)
+        return None
+    return {'member_only': member_only, 'protected': protected, 'live_id': live_id, 'screen_id': screen_id,
+            'user_image': user_image, 'live_title': live_title, 'live_comment': live_comment,
+            'live_thumbnail': live_thumbnail, 'live_date': live_date, 'live_url': live_url,
+            'download_url': download_url, 'created': live_created}
 
-    # Dictionary comprehension of the list of twitcasting users
-    user_ids = {user_id: {"movie_id": None, "notified": False, "downloaded": False, "type": None} for user_id in
-                const.user_ids}
-
-    # Setup session
-    session = requests.Session()
-    session.mount("https://", HTTPAdapter(max_retries=5))
-    live_streams = set()
-    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    threading.Thread(target=loading_text).start()
-
-    # Get output path and if it ends with backward slash then remove it
-    if const.OUTPUT_PATH is not None or "":
-        output_path = Path(const.OUTPUT_PATH).resolve()
-    else:
-        output_path = os.getcwd()
+
+# Always true unless several sharded workers run, then only the first worker to claim a live acts on it
+def claim(kind, user_id, movie_id):
+    return claims is None or claims.claim(kind, user_id, movie_id)
+
+
+def is_still_live(user_id, live_id):
+    return user_id in user_ids and str(user_ids[user_id]['movie_id']) == str(live_id)
+
+
+# Keeps checking the passwords while the live goes on, the password file may get the right one later. The live
+# only counts as downloaded once a password worked
+async def download_protected(user_id, live_id, passwords, output, download_url):
     while True:
+        password = await prober.find(user_id, download_url, passwords)
+        if password is not None:
+            break
+        logger.error(f"None of the passwords unlocked the protected stream at {download_url}")
+        await asyncio.sleep(PASSWORD_RETRY_INTERVAL)
+        if not is_still_live(user_id, live_id):
+            live_details.pop((user_id, str(live_id)), None)
+            return
+        passwords = [datetime.utcnow().strftime("%Y%m%d"), *(get_passwords() or [])]
+    logger.debug(f"Found the password for {download_url}")
+    # Scenario where cookies unlock the video but video-password is still called so error or not
+    yt_dlp_args = ['yt-dlp', *COOKIES, '--no-part', '--embed-metadata']
+    yt_dlp_args += ['--video-password', password, '-o', output, download_url]
+    downloads.submit(user_id, live_id, yt_dlp_args, output)
+    if is_still_live(user_id, live_id):
+        user_ids[user_id]['downloaded'] = True
+    state.mark_downloaded(user_id, live_id)
+
+
+def handle_live(user_id, user_data, live):
+    protected = live['protected']
+    member_only = live['member_only']
+    if member_only:
+        scheduler.mark_member_only(user_id)
+    screen_id = live['screen_id']
+    live_id = live['live_id']
+    live_title = live['live_title']
+    download_url = live['download_url']
+    # If a live stream has been encountered for the first time
+    if not user_data['notified']:
+        # Send notification to discord webhook
+        if WEBHOOK_URL and claim('notify', user_id, live_id):
+            if protected and member_only:
+                live_text = f"{screen_id} has a protected member's only live stream at "
+            elif protected:
+                live_text = f"{screen_id} has a protected live stream at "
+            elif member_only:
+                live_text = f"{screen_id} has a member's only live stream at "
+            else:
+                live_text = f"{screen_id} is now live at "
+            # print(" " * 70, end='\n')
+            logger.info(live_text + download_url)
+            live_text, live_url = format_url_message(screen_id, live_id, live_text, live['live_url'])
+            embed = {
+                "color": 13714,
+                "author": {
+                    "name": screen_id,
+                    "icon_url": live['user_image']
+                },
+                "fields": [
+                    {
+                        "name": f"{live_title}\n{live['live_comment']}\n\n{live_text}",
+                        "value": live_url
+                    }
+                ],
+                "image": {
+                    "url": live['live_thumbnail']
+                },
+                "thumbnail": {
+                    "url": live['user_image']
+                }
+            }
+            notifier.notify(embed)
+            if live['created']:
+                metrics.observe('golive_detection_seconds', time.time() - live['created'])
+        user_data['notified'] = True
+        state.mark_notified(user_id, user_data['movie_id'])
+
+    if not user_data['downloaded'] and not claim('download', user_id, live_id):
+        logger.debug(f"Download of {download_url} was claimed by another worker")
+        user_data['downloaded'] = True
+    if not user_data['downloaded']:
+        # Get password list
+        passwords = None
+        if protected:
+            passwords = get_passwords()
+            if passwords is not None:
+                passwords = [datetime.utcnow().strftime("%Y%m%d"), *passwords]
+        #   passwords.add(datetime.now(tz=timezone.utc).strftime("%Y%m%d"))
+
+        # Download the live stream
+        job = prestarted.pop((user_id, str(live_id)), None)
+        if job is not None and protected:
+            # Started before it was known the live needs a password, the password probe starts over
+            discard_download(job)
+            job = None
+        # A download that already started stays on its volume
+        root = storage.root_of(job.output) if job is not None else storage.place()
+        if root is None:
+            return
+        file_name = storage.file_name(live['live_date'], live_title, live_id, screen_id)
+        output = os.path.join(root, screen_id, file_name)
+        logger.debug(f"Download Path: {output}")
+        live_details[(user_id, str(live_id))] = live
+        if comments is not None:
+            comments.start(user_id, live_id, output)
+        if job is None:
+            # logger.info(f"Downloading {download_url}\n")
+            logger.info(f"Downloading {download_url}")
+        if job is not None:
+            # Already recording since the live was detected, it only gets its proper name
+            downloads.rename(job, output)
+        elif not protected and not member_only:
+            yt_dlp_args = [*download_args(), '-o', output, download_url]
+
+            # streamlink_args = ['streamlink', '-o', output, download_url, 'best']
+            # The built-in recorder is tried first, yt-dlp is the fallback
+            recording = recorder.recording(screen_id) if recorder is not None else None
+            downloads.submit(user_id, live_id, yt_dlp_args, output, recording)
+        elif protected and passwords is not None:
+            # Find the password that unlocks the stream first and only then start a single download
+            # If stream happens to also be a password protected member's only stream this should work too
+            task = asyncio.get_running_loop().create_task(
+                download_protected(user_id, live_id, passwords, output, download_url))
+            protected_tasks[(user_id, str(live_id))] = task
+            task.add_done_callback(lambda _, key=(user_id, str(live_id)): protected_tasks.pop(key, None))
+            return
+        elif member_only:
+            yt_dlp_args = ['yt-dlp', *COOKIES, '--no-part']
+            yt_dlp_args += ['--embed-metadata', '-o', output, download_url]
+            downloads.submit(user_id, live_id, yt_dlp_args, output)
+        else:
+            logger.error(f"Failed to download protected stream at {download_url}")
+            live_details.pop((user_id, str(live_id)), None)
+        user_data['downloaded'] = True
+        state.mark_downloaded(user_id, user_data['movie_id'])
+
+
+def on_download_finished(job):
+    live = live_details.pop((job.user_id, job.live_id), None)
+    for path in downloads.outputs(job):
+        storage.add(live['screen_id'] if live else job.user_id, job.live_id, path)
+        if postprocessor is not None:
+            postprocessor.submit(path, live)
+
+
+def update_status(cycle=None):
+    fields = {'watched': len(user_ids),
+              'live': sum(data['movie_id'] is not None for data in user_ids.values()),
+              'downloads': len(downloads.active()),
+              'limited': limiter.is_limited()}
+    if cycle is not None:
+        fields['cycle'] = cycle
+    status.update(**fields)
+
+
+async def watch():
+    service.install()
+    session = await poller.start()
+    notifier.start(session)
+    downloads.start()
+    loop = asyncio.get_running_loop()
+    background = [loop.create_task(config.watch(getattr(const, 'CONFIG_RELOAD_INTERVAL', 5))),
+                  loop.create_task(status.run(logger)),
+                  loop.create_task(storage.watch())]
+    metrics_runner = None
+    if getattr(const, 'METRICS_PORT', None):
+        metrics_runner = await metrics.serve(getattr(const, 'METRICS_HOST', "127.0.0.1"),
+                                             shard.index + const.METRICS_PORT)
+    if getattr(const, 'METRICS_PATH', None):
+        background.append(loop.create_task(
+            metrics.dump(shard.path(const.METRICS_PATH), getattr(const, 'METRICS_INTERVAL', 60))))
+    if push is not None:
+        await push.start(getattr(const, 'PUSH_HOST', "0.0.0.0"), shard.index + const.PUSH_PORT,
+                         getattr(const, 'PUSH_PATH', "/"))
+        # Polling only has to catch the events that got lost
+        scheduler.reconcile_interval = getattr(const, 'PUSH_RECONCILE_INTERVAL', 120)
+        if getattr(const, 'PUSH_REGISTER', False):
+            background.append(loop.create_task(push.register(poller, api_headers, user_ids)))
+    service.ready()
+    try:
+        await watch_loop()
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if push is not None:
+            await push.close()
+
+
+async def watch_loop():
+    while not service.stopping:
         try:
+            service.heartbeat(status.text())
             # logger.debug(user_ids)
-            time.sleep(1)
+            # Sleep until the next user is due but never longer than SLEEP_TIME so pending notifications are retried
+            if await service.sleep(min(scheduler.time_until_next(), SLEEP_TIME)):
+                break
             # logger.debug("Fetching Lives...")
-            # Check whether user is currently like
+            # Users found live in the bulk search don't need their own poll for a while
+            if bulk.is_due():
+                bulk_lives = await bulk.fetch(list(user_ids))
+                add_live_users(bulk_lives)
+                for stream_json, user_id in bulk_lives:
+                    # The search already returns the whole profile so enrichment doesn't have to fetch it again
+                    cache.put(('user', user_id), {'user': stream_json['bulk']['broadcaster']}, PROFILE_CACHE_TTL)
+                    scheduler.mark_searched(user_id)
+                    scheduler.record(user_id, True)
+                    scheduler.defer(user_id, bulk.interval)
+                if bulk.healthy:
+                    scheduler.covered_until = time.time() + bulk.interval * 3
+            # Check whether the users that are due are currently live
+            cycle_started = time.monotonic()
+            due_users = scheduler.due_users()
             try:
-                lives = asyncio.run(get_lives())
-                logger.debug(lives)
+                lives = await poller.get_lives(due_users) if due_users else []
+                if lives:
+                    logger.debug(lives)
             except aiohttp.ServerDisconnectedError as server_error:
                 if len(str(server_error)) > 0:
-                    logger.error(f"{server_error}{' '*22}")
+                    logger.error(server_error)
                 else:
                     logger.debug(f"Error {server_error}", exc_info=True)
+                schedule_next_polls([({'error': True}, user_id) for user_id in due_users])
                 continue
-            except aiohttp.ClientOSError as client_error:
-                logger.error(f"{client_error}{' '*20}")
             except Exception as e:
                 logger.error(e)
+                schedule_next_polls([({'error': True}, user_id) for user_id in due_users])
                 continue
-            try:
-                add_live_users(lives)
-            except NameError:
-                logger.error("Connection issue...")
+            add_live_users(lives)
+            schedule_next_polls(lives)
+            update_status(time.monotonic() - cycle_started if due_users else None)
+            if due_users:
+                metrics.observe('poll_cycle_seconds', time.monotonic() - cycle_started)
+                metrics.observe('poll_cycle_users', len(due_users), buckets=(1, 10, 50, 100, 500, 1000, 5000))
+
+            # Resolve every newly live user at once and then notify/download in the order they resolved, a live
+            # restored after a restart was already notified but its download still has to be started again
+            pending = [user_id for user_id, user_data in user_ids.items()
+                       if user_data['movie_id'] is not None and
+                       (not user_data['notified'] or not user_data['downloaded']) and
+                       (user_id, str(user_data['movie_id'])) not in protected_tasks]
+            if not pending:
                 continue
-            for user_id, user_data in user_ids.items():
-                try:
-                    if user_data['movie_id'] is not None and not user_data['notified']:
-                        res = {}
-                        headers = {'Authorization': f'Basic {ACCESS_TOKEN}',
-                                   'Accept': 'application/json',
-                                   'X-Api-Version': '2.0'}
-                        response = session.get(f"https://apiv2.twitcasting.tv/users/{user_id}/current_live",
-                                               headers=headers)
-                        if response.status_code == 401:
-                            logger.error("Error with tokens")
-                            continue
-                        res = response.json()
-                        logger.debug(res)
-                        live_url = f"https://twitcasting.tv/{user_id}/movie/{user_data['movie_id']}"
-                        if 'movie_id' in res and res['movie_id'] is not None:
-                            # Check if it's a member's only stream
-                            is_member = check_member_stream(user_id)
-                            logger.debug(is_member)
-                            if is_member:
-                                res['member_only'] = True
-                    else:
-                        # logger.info(f"{user_id} is currently offline...")
-                        continue
-                except requests.exceptions.ConnectionError as cError:
-                    logger.error(cError)
-                except (requests.exceptions.RequestException, json.decoder.JSONDecodeError) as rerror:
-                    logger.error(rerror)
+            results = await asyncio.gather(*(resolve_live(user_id) for user_id in pending), return_exceptions=True)
+            for user_id, live in zip(pending, results):
+                if isinstance(live, Exception):
+                    logger.error(live, exc_info=live)
+                    continue
+                if live is None:
                     continue
-                # If res returns a json with an error key then it is not currently live
-                if 'error' in res and res['error']['code'] == 404:
-                    error_res = res
-                    res = check_latest_live(user_id, session, logger)
-                    if res == {}:
-                        member_res, data = poll_member_stream(user_id)
-                        # maybe also checking member_res is not necessary
-                        if member_res and user_ids[user_id]["type"] == "Live":
-                            # For now use live thumbnail instead of pfp
-                            try:
-                                res = {'movie': {'id': user_ids[user_id]['movie_id'], 'title': data['title'],
-                                                 'subtitle': data['subtitle'],
-                                                 'last_owner_comment': None, 'is_protected': data['is_protected'],
-                                                 'date': data['date'],
-                                                 'member_thumbnail': data['thumbnail']},
-                                       'broadcaster': {'screen_id': user_id,
-                                                       'image': data['image']},
-                                       'member_only': True}
-                                logger.debug(res)
-                            except Exception as e:
-                                logger.error(e, exc_info=True)
-                        else:
-                            continue
-                    else:
-                        res['member_only'] = True
-                        res['movie']['member_thumbnail'] = res['movie']['small_thumbnail']
-                    # If the request could not be sent due to an invalid bearer token
-                    if error_res['error']['code'] == 1000:
-                        logger.error("Invalid bearer token")
-                        quit()
-                # TODO set default values in event not found
                 try:
-                    member_only = res['member_only'] if 'member_only' in res else False
-                    protected = res['movie']['is_protected'] if 'is_protected' in res['movie'] else False
-                    live_id = res['movie']['id']
-                    screen_id = res['broadcaster']['screen_id']
-                    user_image = res['broadcaster']['image']
-                    live_title = res['movie']['title']
-                    live_comment = get_secondary_title(res)
-                    if 'member_thumbnail' not in res['movie']:
-                        if 'large_thumbnail' in res['movie']:
-                            live_thumbnail = res['movie']['large_thumbnail']
-                        else:
-                            live_thumbnail = f"https://apiv2.twitcasting.tv/users/{user_id}/live/thumbnail?size=large&position=latest"
-                    else:
-                        live_thumbnail = res['movie']['member_thumbnail']
-                    if 'created' in res['movie']:
-                        live_date = datetime.fromtimestamp(res['movie']['created']).strftime('%Y%m%d')
-                    else:
-                        live_date = res['movie']['date']
-                    if "_" not in screen_id[0] or "_" not in screen_id[-1]:
-                        live_url = f"https://twitcasting.tv/{screen_id}/movie/{live_id}"
-                    else:
-                        live_url = f"`https://twitcasting.tv/{screen_id}/movie/{live_id}`"
-                    download_url = f"https://twitcasting.tv/{screen_id}/movie/{live_id}"
-                except KeyError as kError:
-                    logger.error(kError, exc_info=True)
-                # If a live stream has been encountered for the first time
-                if not user_data['notified']:
-                    # Send notification to discord webhook
-                    if WEBHOOK_URL is not None:
-                        if protected and member_only:
-                            live_text = f"{screen_id} has a protected member's only live stream at "
-                        elif protected:
-                            live_text = f"{screen_id} has a protected live stream at "
-                        elif member_only:
-                            live_text = f"{screen_id} has a member's only live stream at "
-                        else:
-                            live_text = f"{screen_id} is now live at "
-                        # print(" " * 70, end='\n')
-                        logger.info(live_text + download_url)
-                        live_text, live_url = format_url_message(screen_id, live_id, live_text, live_url)
-                        message = {"embeds": [{
-                            "color": 13714,
-                            "author": {
-                                "name": screen_id,
-                                "icon_url": user_image
-                            },
-                            "fields": [
-                                {
-                                    "name": f"{live_title}\n{live_comment}\n\n{live_text}",
-                                    "value": live_url
-                                }
-                            ],
-                            "image": {
-                                "url": live_thumbnail
-                            },
-                            "thumbnail": {
-                                "url": user_image
-                            }
-                        }]
-                        }
-                        requests.post(WEBHOOK_URL, json=message)
-                        user_data['notified'] = True
-
-                if not user_data['downloaded']:
-                    # Get password list
-                    passwords = None
-                    if protected:
-                        passwords = get_passwords()
-                        passwords.add(datetime.utcnow().strftime("%Y%m%d"))
-                    #   passwords.add(datetime.now(tz=timezone.utc).strftime("%Y%m%d"))
-
-                    # Download the live stream
-                    # logger.info(f"Downloading {download_url}\n")
-                    logger.info(f"Downloading {download_url}")
-                    file_name = check_file(live_date, live_title, live_id, screen_id, output_path)
-                    output = f'{output_path}/{screen_id}/{file_name}'
-                    logger.debug(f"Download Path: {output}")
-                    if not protected and not member_only:
-                        yt_dlp_args = ['start', f'auto-twitcasting {screen_id} {live_id}', '/min', 'cmd', '/k',
-                                       'yt-dlp', *COOKIES, '--no-part', '--embed-metadata', '-N', '4']
-                        yt_dlp_args += ['-o', output, download_url]
-
-                        streamlink_args = ['start', f'auto-twitcasting {screen_id} {live_id}', '/min', 'cmd', '/c', 'streamlink', '-o', output, download_url, 'best']
-                        # TODO:     get output from result so I can log it
-                        # result = subprocess.run(streamlink_args, shell=True)
-                        result = subprocess.run(yt_dlp_args, shell=True)
-                    elif protected and passwords is not None:
-                        # Try downloading protected streams by trying all the passwords
-                        # If stream happens to also be a password protected member's only stream this should work too
-                        # This will open up a console for each password so make sure the password list isn't too long...
-                        for password in passwords:
-                            # Scenario where cookies unlock the video but video-password is still called so error or not
-                            yt_dlp_args = ['start', f'auto-twitcasting {screen_id} {live_id}', '/min', 'cmd', '/c',
-                                           'yt-dlp', *COOKIES, '--no-part', '--embed-metadata']
-                            yt_dlp_args += ['--video-password', password, '-o', output, download_url]
-                            result = subprocess.run(yt_dlp_args, shell=True)
-                            # TODO pass check and if output by making another call checking -F and does not contain "ERROR:" then break out
-                            # time.sleep(1)
-                    elif member_only:
-                        yt_dlp_args = ['start', f'auto-twitcasting {screen_id} {live_id}', '/min', 'cmd', '/c',
-                                       'yt-dlp', *COOKIES, '--no-part']
-                        yt_dlp_args += ['--embed-metadata', '-o', output, download_url]
-                        result = subprocess.run(yt_dlp_args, shell=True)
-                    else:
-                        logger.error(f"Failed to download protected stream at {download_url}")
-                    user_data['downloaded'] = True
+                    handle_live(user_id, user_ids[user_id], live)
+                except Exception as e:
+                    logger.error(e, exc_info=True)
         except Exception as e:
             logger.error(e, exc_info=True)
+
+
+# Sends what is still queued and either stops the downloads or lets them finish,
+# a second signal while waiting stops the downloads right away
+async def shutdown(args):
+    forced = []
+    service.on_force.append(lambda: forced.append(asyncio.get_running_loop().create_task(
+        downloads.close(stop=True, timeout=5))))
+    await notifier.close(timeout=args.shutdown_timeout)
+    # Lives still waiting for a password stay not downloaded and are tried again on the next start
+    for task in protected_tasks.values():
+        task.cancel()
+    if protected_tasks:
+        await asyncio.wait(list(protected_tasks.values()))
+    wait = args.on_shutdown == "wait"
+    running = len(downloads.active()) + len(downloads.queued())
+    if wait and running:
+        logger.info(f"Waiting for {running} download(s) to finish, send the signal again to stop them")
+        # Nothing is polled anymore so a download that dies can't be told apart from the live ending
+        downloads.is_live = None
+    await downloads.close(stop=not wait, timeout=None if wait else args.shutdown_timeout)
+    if forced:
+        await asyncio.wait(forced)
+    for job in downloads.interrupted:
+        state.clear_downloaded(job.user_id, job.live_id)
+    if comments is not None:
+        await comments.close(timeout=args.shutdown_timeout)
+    if postprocessor is not None:
+        await postprocessor.close(timeout=args.shutdown_timeout)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Watch twitcasting users, send their lives to discord and download them")
+    parser.add_argument("--headless", action="store_true",
+                        help="never draw the status line, log a summary every STATUS_INTERVAL seconds instead")
+    parser.add_argument("--on-shutdown", choices=["stop", "wait"], default="stop",
+                        help="stop the running downloads or wait for them to finish when asked to exit")
+    parser.add_argument("--shutdown-timeout", type=float, default=30,
+                        help="seconds to wait for unsent notifications and for stopped downloads to exit")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    status = StatusDisplay(interactive=False if args.headless else None, interval=getattr(const, 'STATUS_INTERVAL', 300))
+    logger = create_logger(status.wrap(sys.stderr))
+    logger.info("Starting program")
+    service = Service(logger)
+
+    # Setup
+    SLEEP_TIME = const.SLEEP_TIME
+    WEBHOOK_URL = const.WEBHOOK_URL
+    REQUEST_TIMEOUT = getattr(const, 'REQUEST_TIMEOUT', 10)
+    PROFILE_CACHE_TTL = getattr(const, 'PROFILE_CACHE_TTL', 3600)
+    MOVIE_CACHE_TTL = getattr(const, 'MOVIE_CACHE_TTL', 15)
+    MEMBER_PAGE_PARSER = getattr(const, 'MEMBER_PAGE_PARSER', "stream")
+    cache = MetadataCache(getattr(const, 'METADATA_CACHE_SIZE', 2048))
+
+    config = ConfigStore(logger, const, on_change=apply_config)
+
+    # When started by shard.py this process only watches its own part of the users with its own credentials
+    shard = Shard.from_env()
+    claims = None
+    if shard.enabled:
+        CLIENT_ID, CLIENT_SECRET = shard.credentials(getattr(const, 'SHARDS', None), CLIENT_ID, CLIENT_SECRET)
+        ACCESS_TOKEN = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode("utf-8")
+        claims = ClaimStore(getattr(const, 'CLAIMS_PATH', None) or "claims.sqlite3", shard.name)
+        logger.info(f"Running as {shard.name} of {shard.count}")
+
+    logger.debug(f'Authorization: Basic {ACCESS_TOKEN}')
+
+    COOKIES = get_cookies(const.COOKIES)
+
+    # Dictionary comprehension of the list of twitcasting users
+    user_ids = {user_id: {"movie_id": None, "notified": False, "downloaded": False, "type": None} for user_id in
+                config.user_ids if shard.owns(user_id)}
+    # Restore the lives that were still going on when the program last stopped
+    state = StateStore(shard.path(getattr(const, 'STATE_PATH', None) or "state.sqlite3"))
+    for user_id, user_data in state.restore().items():
+        if user_id in user_ids:
+            user_ids[user_id] = user_data
+
+    # The default event loop is used on every platform, on Windows that is the proactor loop which is needed
+    # to run the downloads as subprocesses
+    limiter = RateLimiter(logger, getattr(const, 'RATE_LIMITS', None))
+    poller = LivePoller(logger, limiter,
+                        limit=getattr(const, 'POLL_CONNECTION_LIMIT', 100),
+                        limit_per_host=getattr(const, 'POLL_CONNECTION_LIMIT_PER_HOST', 30),
+                        concurrency=getattr(const, 'POLL_CONCURRENCY', 50))
+    scheduler = PollScheduler(user_ids,
+                              min_interval=getattr(const, 'MIN_POLL_INTERVAL', SLEEP_TIME),
+                              max_interval=getattr(const, 'MAX_DETECTION_LATENCY', 60),
+                              recent_window=getattr(const, 'RECENT_OFFLINE_WINDOW', 1800),
+                              search_window=getattr(const, 'BULK_COVERAGE_DAYS', 7) * 86400,
+                              unknown_grace=getattr(const, 'UNKNOWN_USER_GRACE', 3600))
+    for user_id, started, ended in state.history(time.time() - getattr(const, 'SCHEDULER_HISTORY_DAYS', 30) * 86400):
+        scheduler.seed(user_id, started, ended)
+    bulk = BulkDetector(logger, poller, api_headers,
+                        sources=getattr(const, 'BULK_SOURCES', ('new',)),
+                        interval=getattr(const, 'BULK_INTERVAL', 10))
+    notifier = WebhookNotifier(logger, WEBHOOK_URL,
+                               max_queue=getattr(const, 'WEBHOOK_QUEUE_SIZE', 1000),
+                               max_retries=getattr(const, 'WEBHOOK_MAX_RETRIES', 5))
+    PRESTART_DOWNLOADS = getattr(const, 'PRESTART_DOWNLOADS', True)
+    prestarted = {}
+    pool = None
+    if getattr(const, 'DOWNLOAD_WARM_POOL', 0):
+        pool = WarmPool(logger, download_args(), os.path.join(get_output_paths(const.OUTPUT_PATH)[0], ".warm"),
+                        size=const.DOWNLOAD_WARM_POOL)
+    downloads = DownloadManager(logger, is_live=is_still_live, pool=pool,
+                                max_concurrent=getattr(const, 'MAX_DOWNLOADS', 10),
+                                max_per_disk=getattr(const, 'MAX_DOWNLOADS_PER_DISK', 4),
+                                max_restarts=getattr(const, 'DOWNLOAD_MAX_RESTARTS', 3))
+    recorder = None
+    if getattr(const, 'RECORDER', "yt-dlp") == "native":
+        if PRESTART_DOWNLOADS:
+            logger.warning("PRESTART_DOWNLOADS records every live with yt-dlp before the native recorder could, "
+                           "set it to False to use RECORDER = \"native\"")
+        recorder = HLSRecorder(logger, poller, buffer_size=getattr(const, 'RECORDER_BUFFER_SIZE', 1 << 20),
+                               max_segment_failures=getattr(const, 'RECORDER_MAX_SEGMENT_FAILURES', 5),
+                               ffmpeg=getattr(const, 'FFMPEG_PATH', "ffmpeg"))
+    push = None
+    if getattr(const, 'PUSH_PORT', None):
+        if getattr(const, 'PUSH_SIGNATURE', None):
+            push = PushReceiver(logger, const.PUSH_SIGNATURE, on_push)
+        else:
+            logger.error("PUSH_SIGNATURE is not set, not starting the webhook receiver")
+    prober = PasswordProber(logger, COOKIES, concurrency=getattr(const, 'PASSWORD_CHECK_CONCURRENCY', 4))
+    PASSWORD_RETRY_INTERVAL = getattr(const, 'PASSWORD_RETRY_INTERVAL', 60)
+    protected_tasks = {}
+    metrics.gauge('users_watched', lambda: len(user_ids))
+    metrics.gauge('users_live', lambda: sum(data['movie_id'] is not None for data in user_ids.values()))
+    downloads.on_change = update_status
+    storage = Storage(logger, get_output_paths(const.OUTPUT_PATH),
+                      shard.path(getattr(const, 'ARCHIVE_INDEX_PATH', None) or "archive.sqlite3"),
+                      min_free=getattr(const, 'STORAGE_MIN_FREE_GB', 5) * 1024 ** 3,
+                      warn_free=getattr(const, 'STORAGE_WARN_FREE_GB', 20) * 1024 ** 3,
+                      writes=lambda: [job.rename_to or job.output for job in downloads.active()])
+    live_details = {}
+    postprocessor = None
+    if getattr(const, 'POSTPROCESS', False):
+        postprocessor = PostProcessor(logger, lambda: poller.session,
+                                      steps=getattr(const, 'POSTPROCESS_STEPS', DEFAULT_STEPS),
+                                      workers=getattr(const, 'POSTPROCESS_WORKERS', 1),
+                                      nice=getattr(const, 'POSTPROCESS_NICE', 10),
+                                      ffmpeg=getattr(const, 'FFMPEG_PATH', "ffmpeg"),
+                                      ffprobe=getattr(const, 'FFPROBE_PATH', "ffprobe"),
+                                      disk_busy=downloads.disk_busy,
+                                      max_busy=getattr(const, 'POSTPROCESS_MAX_BUSY', 2))
+    downloads.on_finish = on_download_finished
+    comments = None
+    if getattr(const, 'COMMENTS', False):
+        comments = CommentArchiver(logger, poller, api_headers,
+                                   interval=getattr(const, 'COMMENTS_INTERVAL', 5),
+                                   max_interval=getattr(const, 'COMMENTS_MAX_INTERVAL', 30),
+                                   budget=getattr(const, 'COMMENTS_REQUEST_BUDGET', 30),
+                                   level=getattr(const, 'COMMENTS_COMPRESSION_LEVEL', 3),
+                                   max_backfill=getattr(const, 'COMMENTS_MAX_BACKFILL', 5000))
+
+    exit_code = EXIT_OK
+    try:
+        poller.run(watch())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        exit_code = EXIT_ERROR
+    else:
+        if service.exit_code is not None:
+            exit_code = service.exit_code
+    finally:
+        try:
+            poller.run(shutdown(args))
+        finally:
+            poller.shutdown()
+            status.clear()
+            state.close()
+            storage.close()
+            if claims is not None:
+                claims.close()
+    logger.info(f"Stopped with exit code {exit_code}")
+    sys.exit(exit_code)
@@ -1,43 +1,81 @@
+import atexit
+from collections import OrderedDict
 import logging
-from io import BytesIO
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 import os.path
+import queue
+import threading
+import time
 import const
-import datetime
 import gzip
 import shutil
 import zstandard as zstd
 
 
-# def namer(name):
-#     return name + ".zst"
-#
-#
-# def rotator(source, dest):
-#     compression_level = 3
-#     with open(source, 'rb') as input_file:
-#         with open(source + ".copy", 'wb') as copy_file:
-#             shutil.copyfileobj(input_file, copy_file)
-#     with open(source + ".copy", 'rb') as input_file:
-#         input_data = input_file.read()
-#         cctx = zstd.ZstdCompressor(level=compression_level)
-#         compressed_data = cctx.compress(input_data)
-#         with zstd.open(dest, 'wb') as output_file:
-#             output_file.write(compressed_data)
-#     os.remove(source + ".copy")
-#     os.remove(source)
+COMPRESSION_LEVEL = getattr(const, 'LOG_COMPRESSION_LEVEL', 3)
+
 
 def namer(name):
-    return name + ".gz"
+    return name + ".zst"
 
 
+def compress(source, dest):
+    with open(source, 'rb') as input_file:
+        with open(dest + ".tmp", 'wb') as output_file:
+            # Stream the file through the compressor instead of reading the whole log into memory
+            cctx = zstd.ZstdCompressor(level=COMPRESSION_LEVEL)
+            cctx.copy_stream(input_file, output_file)
+    os.replace(dest + ".tmp", dest)
+    os.remove(source)
+
+
+# Only renames the log inside the handler and compresses it on another thread so logging isn't held up
 def rotator(source, dest):
+    pending = dest + ".rotating"
+    os.replace(source, pending)
+    threading.Thread(target=compress, args=(pending, dest), name="log-compress").start()
+
+
+def compress_leftovers(log_dir):
+    for name in os.listdir(log_dir):
+        if name.endswith(".rotating"):
+            path = os.path.join(log_dir, name)
+            threading.Thread(target=compress, args=(path, path[:-len(".rotating")]), name="log-compress").start()
+
+
+def gzip_namer(name):
+    return name + ".gz"
+
+
+def gzip_rotator(source, dest):
     with open(source, 'rb') as f_in:
         with gzip.open(dest, 'wb') as f_out:
             shutil.copyfileobj(f_in, f_out)
     os.remove(source)
 
 
+# Large debug payloads(entire json responses) are sampled and truncated before they are formatted into the queue
+class PayloadFilter(logging.Filter):
+    def __init__(self, max_length=2000, sample_every=10):
+        super().__init__()
+        self.max_length = max_length
+        self.sample_every = sample_every
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not self.max_length:
+            return True
+        message = record.getMessage()
+        if len(message) <= self.max_length:
+            return True
+        self.count += 1
+        if self.sample_every > 1 and self.count % self.sample_every != 1:
+            return False
+        record.msg = f"{message[:self.max_length]}... [{len(message) - self.max_length} characters truncated]"
+        record.args = None
+        return True
+
+
 # Filter subclass that does not allow the file logging of sleeping messages
 class NoParsingFilter(logging.Filter):
     previous_record = None
@@ -60,29 +98,105 @@ class NoParsingFilter(logging.Filter):
 #         return 'is currently offline' not in record.getMessage()
 
 
+# Suppresses repeats of the same message(same template and arguments) within a window and caps how many records
+# each logger can emit per second, so the log volume stays flat however many users are watched.
+# Suppressed and dropped records are reported with a summary record put straight on the queue
 class DuplicateFilter(logging.Filter):
-    previous_record = None
-    count = 0
+    def __init__(self, sink, window=60, max_keys=1000, rate=20, burst=100, summary_interval=60):
+        super().__init__()
+        self.sink = sink
+        self.window = window
+        self.max_keys = max_keys
+        self.rate = rate
+        self.burst = burst
+        self.summary_interval = summary_interval
+        # key -> [first seen, suppressed count, last record], oldest first
+        self.recent = OrderedDict()
+        # logger name -> [tokens, last refill, dropped count]
+        self.buckets = {}
+        self.evicted = 0
+        self.next_summary = time.monotonic() + summary_interval
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(record):
+        try:
+            args = hash(record.args) if isinstance(record.args, tuple) else hash(repr(record.args))
+        except TypeError:
+            args = hash(repr(record.args))
+        return record.name, record.levelno, str(record.msg), args
+
+    def summary(self, record, text):
+        summary = logging.makeLogRecord({'name': record.name, 'levelno': record.levelno,
+                                         'levelname': record.levelname, 'pathname': record.pathname,
+                                         'filename': record.filename, 'lineno': record.lineno,
+                                         'msg': text, 'args': None})
+        self.sink(summary)
+
+    def allow_rate(self, record, now):
+        if record.levelno >= logging.ERROR or not self.rate:
+            return True
+        bucket = self.buckets.get(record.name)
+        if bucket is None:
+            bucket = self.buckets[record.name] = [self.burst, now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        return True
+
+    def flush(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.next_summary = now + self.summary_interval
+        for key in list(self.recent):
+            first_seen, suppressed, record = self.recent[key]
+            if now - first_seen < self.window:
+                break
+            del self.recent[key]
+            if suppressed:
+                self.summary(record, f"Suppressed {suppressed} similar messages: {record.getMessage()[:200]}")
+        for name, bucket in self.buckets.items():
+            if bucket[2]:
+                self.sink(logging.makeLogRecord({'name': name, 'levelno': logging.WARNING, 'levelname': "WARNING",
+                                                 'msg': f"Dropped {bucket[2]} messages over the rate limit of "
+                                                        f"{self.rate}/s", 'args': None}))
+                bucket[2] = 0
+        if self.evicted:
+            self.sink(logging.makeLogRecord({'name': __name__, 'levelno': logging.DEBUG, 'levelname': "DEBUG",
+                                             'msg': f"Forgot {self.evicted} repeated messages to stay under "
+                                                    f"{self.max_keys} tracked messages", 'args': None}))
+            self.evicted = 0
 
     def filter(self, record):
-        record_matches = False
-        if logging.getLogger().level == logging.DEBUG:
-            if NoParsingFilter.previous_record is None:
-                NoParsingFilter.previous_record = record.getMessage()
-            elif record == NoParsingFilter.previous_record:
-                NoParsingFilter.count += 1
-                record_matches = True
-            else:
-                NoParsingFilter.count = 0
-            if NoParsingFilter.count % 1000 == 0:
-                record.message = "Filtered 1000 identical message"
-        return not record_matches
-
-
-def create_logger():
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_summary:
+                self.flush(now)
+            key = self.key(record)
+            entry = self.recent.get(key)
+            if entry is not None:
+                if now - entry[0] < self.window:
+                    entry[1] += 1
+                    entry[2] = record
+                    return False
+                # The window has passed so let it through again and say how many were hidden in between
+                del self.recent[key]
+                if entry[1]:
+                    record.msg = f"{record.msg} (suppressed {entry[1]} similar messages)"
+            if not self.allow_rate(record, now):
+                return False
+            self.recent[key] = [now, 0, record]
+            if len(self.recent) > self.max_keys:
+                _, (_, suppressed, _) = self.recent.popitem(last=False)
+                self.evicted += suppressed
+            return True
+
+
+def create_logger(console_stream=None):
     # Check if log dir exist and if not create it
-    logging.handlers.TimedRotatingFileHandler
-    log_dir = os.getcwd()+"\\logs"
+    log_dir = os.path.join(os.getcwd(), "logs")
     if not os.path.isdir(log_dir):
         os.makedirs(log_dir)
 
@@ -94,41 +208,52 @@ def create_logger():
         return logger
 
     # Set logging level and log path
-    logger.setLevel(logging.DEBUG)
-    current_date = str(datetime.date.today()).replace("-", "")
-    log_path = f"{log_dir}\\logfile.log"
-
-    # Create a new log file everyday
-    handler = TimedRotatingFileHandler(log_path, when="midnight", interval=1, encoding='utf-8', backupCount=1)
-    formatter = logging.Formatter('%(asctime)s [%(filename)s:%(lineno)d] %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    handler.setFormatter(formatter)
-    handler.suffix = "%Y%m%d"   # file suffix to be changed
-    handler.addFilter(NoParsingFilter())
-    handler.rotator = rotator
-    handler.namer = namer
-    # logging.basicConfig(level=logging.INFO,
-    #                     format='%(asctime)s [%(filename)s:%(lineno)d] %(levelname)-5s %(message)s',
-    #                     datefmt='%Y-%m-%d %H:%M',
-    #                     filename=log_path)
+    logger.setLevel(getattr(const, 'LOG_LEVEL', logging.DEBUG))
+    # Sharded workers started by shard.py each get their own log file
+    shard = os.environ.get("AUTO_TWITCASTING_SHARD")
+    log_name = f"logfile-{shard.split('/')[0]}.log" if shard else "logfile.log"
+    log_path = os.path.join(log_dir, log_name)
 
     # define a Handler which writes DEBUG messages or higher to the sys.stderr
-    console = logging.StreamHandler()
+    console = logging.StreamHandler(console_stream)
     console.setLevel(logging.INFO)
     # set a format which is simpler for console use
-    # console_formatter = logging.Formatter(f'[%(levelname)s] %(asctime)s | %(message)s {" "*10}', datefmt='%Y-%m-%d %H:%M:%S')
-    console_formatter = logging.Formatter(f'[%(levelname)s] %(asctime)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    console_formatter = logging.Formatter('[%(levelname)s] %(asctime)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     # tell the handler to use this format
     console.setFormatter(console_formatter)
-    # add the handlers to the root logger
-    logger.addHandler(console)
-    logger.addHandler(handler)
+    handlers = [console]
 
-    # If logging is not enabled then remove the root log handler but keep the stream handler
-    if not const.LOGGING:
-        try:
-            lhStdout = logger.handlers[1]
-            logger.removeHandler(lhStdout)
-        except IndexError as ierror:
-            logger.error(ierror)
-            return logger
+    # If logging is not enabled then only log to the console
+    if const.LOGGING:
+        # Create a new log file everyday
+        handler = TimedRotatingFileHandler(log_path, when="midnight", interval=1, encoding='utf-8', backupCount=1)
+        formatter = logging.Formatter('%(asctime)s [%(filename)s:%(lineno)d] %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        handler.setFormatter(formatter)
+        handler.suffix = "%Y%m%d"   # file suffix to be changed
+        handler.addFilter(NoParsingFilter())
+        if getattr(const, 'LOG_COMPRESSION', "zstd") == "gzip":
+            handler.rotator = gzip_rotator
+            handler.namer = gzip_namer
+        else:
+            handler.rotator = rotator
+            handler.namer = namer
+            compress_leftovers(log_dir)
+        handlers.append(handler)
+
+    # The program only puts records on a queue, formatting to the console and writing/rotating the file
+    # happens on the listener thread
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(PayloadFilter(getattr(const, 'LOG_MAX_MESSAGE_LENGTH', 2000),
+                                          getattr(const, 'LOG_SAMPLE_EVERY', 10)))
+    duplicate_filter = DuplicateFilter(log_queue.put_nowait, getattr(const, 'LOG_DUPLICATE_WINDOW', 60),
+                                       getattr(const, 'LOG_DUPLICATE_KEYS', 1000),
+                                       getattr(const, 'LOG_RATE_LIMIT', 20), getattr(const, 'LOG_RATE_BURST', 100))
+    queue_handler.addFilter(duplicate_filter)
+    logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # atexit runs in reverse order so the last summaries are queued before the listener stops
+    atexit.register(listener.stop)
+    atexit.register(duplicate_filter.flush, float('inf'))
     return logger
@@ -0,0 +1,139 @@
+import asyncio
+import bisect
+import json
+import os
+import time
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+# Small in-process metrics registry that can be scraped in the prometheus text format or dumped as json
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_callbacks = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    # Gauges that are read when the metrics are collected instead of being updated on the hot path
+    def gauge(self, name, callback):
+        self.gauge_callbacks[name] = callback
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = _label_key(labels)
+        if key not in series:
+            series[key] = Histogram(buckets)
+        series[key].observe(value)
+
+    def _collect_gauges(self):
+        gauges = {name: dict(series) for name, series in self.gauges.items()}
+        for name, callback in self.gauge_callbacks.items():
+            try:
+                gauges[name] = {(): callback()}
+            except Exception:
+                continue
+        return gauges
+
+    def render(self):
+        lines = []
+        for kind, families in (("counter", self.counters), ("gauge", self._collect_gauges())):
+            for name, series in sorted(families.items()):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+        for name, series in sorted(self.histograms.items()):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        def series_dict(series, value=lambda v: v):
+            return {",".join(f"{k}={v}" for k, v in key) or "_": value(item) for key, item in series.items()}
+        return {
+            'time': time.time(),
+            'counters': {name: series_dict(series) for name, series in self.counters.items()},
+            'gauges': {name: series_dict(series) for name, series in self._collect_gauges().items()},
+            'histograms': {name: series_dict(series, lambda h: {'count': h.count, 'sum': h.sum,
+                                                                 'buckets': dict(zip(h.buckets, h.counts))})
+                           for name, series in self.histograms.items()},
+        }
+
+    async def serve(self, host, port):
+        from aiohttp import web
+
+        async def handle_metrics(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        async def handle_json(request):
+            return web.json_response(self.snapshot())
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        app.router.add_get("/metrics.json", handle_json)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    # Periodically writes the json snapshot to a file, written to a temporary file first so readers never see half of it
+    async def dump(self, path, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+                json.dump(self.snapshot(), snapshot_file)
+            os.replace(temp_path, path)
+
+
+metrics = Metrics()
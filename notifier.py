@@ -0,0 +1,141 @@
+import asyncio
+import time
+import aiohttp
+from metrics import metrics
+
+
+# Discord accepts at most 10 embeds per webhook message
+MAX_EMBEDS = 10
+
+
+class WebhookWorker:
+    def __init__(self, logger, url, max_queue, max_retries, batch_window):
+        self.logger = logger
+        self.url = url
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.max_retries = max_retries
+        self.batch_window = batch_window
+        self.task = None
+
+    def put(self, embed):
+        try:
+            self.queue.put_nowait(embed)
+            return True
+        except asyncio.QueueFull:
+            self.logger.error(f"Webhook queue is full, dropping notification for {embed.get('author', {}).get('name')}")
+            return False
+
+    # Wait a moment after the first embed so lives that start together go out in a single message
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < MAX_EMBEDS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self, session):
+        while True:
+            batch = await self.next_batch()
+            try:
+                await self.send(session, batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def send(self, session, embeds):
+        attempt = 0
+        while attempt <= self.max_retries:
+            started = time.monotonic()
+            try:
+                async with session.post(self.url, json={"embeds": embeds}) as res:
+                    metrics.observe('webhook_send_seconds', time.monotonic() - started)
+                    metrics.inc('webhook_requests_total', status=res.status)
+                    if res.status < 300:
+                        return True
+                    if res.status == 429:
+                        # Being rate limited does not count as a failed attempt
+                        retry_after = res.headers.get('Retry-After')
+                        try:
+                            body = await res.json(content_type=None)
+                            retry_after = body.get('retry_after', retry_after)
+                        except Exception:
+                            pass
+                        retry_after = float(retry_after) if retry_after is not None else 1.0
+                        self.logger.debug(f"Webhook rate limited, retrying in {retry_after}s")
+                        await asyncio.sleep(retry_after)
+                        continue
+                    if res.status < 500:
+                        self.logger.error(f"Webhook rejected the message with {res.status}: {await res.text()}")
+                        return False
+                    self.logger.debug(f"Webhook error {res.status}: {res.reason}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as clientError:
+                metrics.inc('webhook_request_errors_total')
+                self.logger.debug(f"Webhook error: {clientError!r}")
+            attempt += 1
+            await asyncio.sleep(min(2 ** attempt, 60))
+        names = ", ".join(str(embed.get('author', {}).get('name')) for embed in embeds)
+        self.logger.error(f"Failed to send webhook notification for {names} after {self.max_retries} retries")
+        return False
+
+
+# Background discord notifier, notify() only enqueues so detection never waits on discord
+class WebhookNotifier:
+    def __init__(self, logger, urls, max_queue=1000, max_retries=5, batch_window=1.0):
+        self.logger = logger
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.batch_window = batch_window
+        self.session = None
+        self.workers = []
+        self.set_urls(urls)
+        metrics.gauge('webhook_queue_depth', self.pending)
+
+    # Used when the settings are reloaded, workers of urls that are kept carry on with their queue
+    def set_urls(self, urls):
+        if isinstance(urls, str):
+            urls = [urls]
+        urls = list(dict.fromkeys(urls or []))
+        workers = {worker.url: worker for worker in self.workers}
+        self.workers = []
+        for url in urls:
+            worker = workers.pop(url, None)
+            if worker is None:
+                worker = WebhookWorker(self.logger, url, self.max_queue, self.max_retries, self.batch_window)
+            self.workers.append(worker)
+        for worker in workers.values():
+            if worker.task is not None:
+                worker.task.cancel()
+        if self.session is not None:
+            self.start(self.session)
+
+    def start(self, session):
+        self.session = session
+        for worker in self.workers:
+            if worker.task is None or worker.task.done():
+                worker.task = asyncio.get_running_loop().create_task(worker.run(session))
+
+    def notify(self, embed):
+        queued = False
+        for worker in self.workers:
+            queued = worker.put(embed) or queued
+        return queued
+
+    def pending(self):
+        return sum(worker.queue.qsize() for worker in self.workers)
+
+    # Give queued notifications a chance to go out before stopping the workers
+    async def close(self, timeout=10):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(worker.queue.join() for worker in self.workers)), timeout)
+        except asyncio.TimeoutError:
+            self.logger.error(f"Dropping {self.pending()} unsent webhook notifications")
+        for worker in self.workers:
+            if worker.task is not None:
+                worker.task.cancel()
@@ -0,0 +1,70 @@
+import asyncio
+
+
+# Checks candidate passwords of a protected stream with yt-dlp --simulate which only fetches the metadata,
+# so a single real download can be started with the password that worked
+class PasswordProber:
+    def __init__(self, logger, cookies=None, concurrency=4, timeout=60):
+        self.logger = logger
+        self.cookies = cookies or []
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        # Last password that unlocked a stream for each user, tried first next time
+        self.known = {}
+
+    def order(self, user_id, passwords):
+        passwords = list(dict.fromkeys(passwords))
+        known = self.known.get(user_id)
+        if known in passwords:
+            passwords.remove(known)
+            passwords.insert(0, known)
+        return passwords
+
+    async def probe(self, url, password):
+        args = ['yt-dlp', *self.cookies, '--simulate', '--quiet', '--no-warnings', '--no-playlist',
+                '--video-password', password, url]
+        async with self.semaphore:
+            try:
+                process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                               stdout=asyncio.subprocess.DEVNULL,
+                                                               stderr=asyncio.subprocess.DEVNULL)
+            except OSError as osError:
+                self.logger.error(f"Could not start yt-dlp: {osError}")
+                return False
+            try:
+                return await asyncio.wait_for(process.wait(), self.timeout) == 0
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+
+    async def _probe(self, url, password):
+        try:
+            return password if await self.probe(url, password) else None
+        except asyncio.TimeoutError:
+            self.logger.debug(f"Password check timed out for {url}")
+            return None
+
+    # Returns the first password that unlocks the stream or None, the remaining checks are cancelled on a hit
+    async def find(self, user_id, url, passwords):
+        candidates = self.order(user_id, passwords)
+        if not candidates:
+            return None
+        # The cached password usually still works so try it on its own before fanning out
+        if candidates[0] == self.known.get(user_id):
+            if await self._probe(url, candidates[0]) is not None:
+                return candidates[0]
+            candidates = candidates[1:]
+        tasks = [asyncio.ensure_future(self._probe(url, password)) for password in candidates]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                password = await next_done
+                if password is not None:
+                    self.known[user_id] = password
+                    return password
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return None
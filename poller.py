@@ -0,0 +1,134 @@
+import asyncio
+import contextlib
+import json
+import time
+import aiohttp
+import endpoints
+from metrics import metrics
+from ratelimit import family_for
+
+
+# Long lived poller that owns one event loop and one pooled aiohttp session for the whole process
+# so keep-alive connections to twitcasting are reused between cycles instead of re-handshaking every second
+class LivePoller:
+    def __init__(self, logger, limiter, limit=100, limit_per_host=30, concurrency=50, timeout=10):
+        self.logger = logger
+        self.limiter = limiter
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = None
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             ttl_dns_cache=300, enable_cleanup_closed=True)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def shutdown(self):
+        try:
+            self.run(self.close())
+        finally:
+            self.loop.close()
+
+    # Every request goes through here so the rate limiter and the request metrics see all of them
+    @contextlib.asynccontextmanager
+    async def _send(self, family, url, method="GET", **kwargs):
+        await self.limiter.acquire(family)
+        started = time.monotonic()
+        try:
+            async with self.session.request(method, url, **kwargs) as res:
+                self.limiter.update(family, res.status, res.headers)
+                metrics.inc('twitcasting_requests_total', endpoint=family, status=res.status)
+                metrics.observe('twitcasting_request_seconds', time.monotonic() - started, endpoint=family)
+                yield res
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.inc('twitcasting_request_errors_total', endpoint=family)
+            raise
+
+    # This endpoint can catch membership streams but may rate limit after a while
+    async def fetch_html(self, user_id):
+        headers = {'Accept': 'application/json'}
+        params = {'target': user_id, 'mode': 'client'}
+        async with self.semaphore:
+            try:
+                # The body has to be read inside the context so the connection goes back to the pool
+                async with self._send('streamserver', f"{endpoints.SITE_URL}/streamserver.php", params=params, headers=headers) as res:
+                    try:
+                        return await res.json(content_type=None), user_id
+                    except json.JSONDecodeError as jsonDecodeError:
+                        # streamserver.php answers with an html error page instead of json when it starts limiting
+                        self.logger.debug(jsonDecodeError)
+                        self.logger.debug(f"Error {res.status}: {res.reason}")
+                        self.limiter.penalize('streamserver')
+                        return {}, user_id
+            except (aiohttp.ClientError, asyncio.TimeoutError) as clientError:
+                self.logger.debug(f"{user_id}: {clientError!r}")
+                return {}, user_id
+
+    # Rate limited GET used by the enrichment path, returns the status and the decoded json or text body
+    async def request(self, url, headers=None, params=None, timeout=None, as_json=True, with_headers=False):
+        await self.start()
+        family = family_for(url)
+        kwargs = {'headers': headers, 'params': params}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        async with self._send(family, url, **kwargs) as res:
+            if res.status == 304:
+                body = None
+            elif as_json:
+                body = await res.json(content_type=None)
+            else:
+                body = await res.text()
+            if with_headers:
+                return res.status, body, res.headers
+            return res.status, body
+
+    # Rate limited POST of a json body, returns the status and the decoded json response
+    async def post(self, url, body, headers=None, timeout=None):
+        await self.start()
+        kwargs = {'headers': headers, 'json': body}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        async with self._send(family_for(url), url, method="POST", **kwargs) as res:
+            return res.status, await res.json(content_type=None)
+
+    # Rate limited GET that hands the body to consume(chunk, final) as it arrives and
+    # drops the rest of the response once consume returns True
+    async def stream(self, url, consume, headers=None, timeout=None, chunk_size=16384):
+        await self.start()
+        family = family_for(url)
+        kwargs = {'headers': headers}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        async with self._send(family, url, **kwargs) as res:
+            async for chunk in res.content.iter_chunked(chunk_size):
+                if consume(chunk, False):
+                    return res.status
+            consume(b"", True)
+            return res.status
+
+    async def get_lives(self, user_ids):
+        await self.start()
+        results = await asyncio.gather(*(self.fetch_html(user_id) for user_id in user_ids))
+        live_streams = []
+        for res, user_id in results:
+            if not res:
+                res = {'error': True}
+            live_streams.append((res, user_id))
+        return live_streams
@@ -0,0 +1,176 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import struct
+import subprocess
+import time
+import aiohttp
+
+
+DEFAULT_STEPS = ("remux", "check", "images", "sidecar", "checksum")
+
+
+# Runs in the worker processes so the heavy steps get less cpu and only idle disk time next to the recordings
+def _lower_priority(nice):
+    try:
+        os.nice(nice)
+    except (AttributeError, OSError):
+        pass
+    ionice = shutil.which("ionice")
+    if ionice:
+        subprocess.run([ionice, "-c", "3", "-p", str(os.getpid())], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+
+
+# True when the moov atom comes before the media data, i.e. the file can be played while it is still being read
+def is_faststart(path):
+    try:
+        with open(path, "rb") as video_file:
+            while True:
+                header = video_file.read(8)
+                if len(header) < 8:
+                    return False
+                size, kind = struct.unpack(">I4s", header)
+                if kind == b"moov":
+                    return True
+                if kind == b"mdat":
+                    return False
+                if size == 1:
+                    size = struct.unpack(">Q", video_file.read(8))[0] - 8
+                elif size == 0:
+                    return False
+                video_file.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+def remux(path, ffmpeg):
+    if is_faststart(path):
+        return None
+    temp_path = f"{os.path.splitext(path)[0]}.remux{os.path.splitext(path)[1]}"
+    process = subprocess.run([ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', path, '-map', '0',
+                              '-c', 'copy', '-movflags', '+faststart', temp_path],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return process.stderr.decode(errors="replace").strip() or f"exited with code {process.returncode}"
+    os.replace(temp_path, path)
+    return None
+
+
+# Duration from the container and the errors found by demuxing the whole file without decoding it
+def check(path, ffmpeg, ffprobe):
+    result = {'duration': None, 'errors': []}
+    probe = subprocess.run([ffprobe, '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', path],
+                           stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        result['duration'] = float(json.loads(probe.stdout)['format']['duration'])
+    except (ValueError, KeyError, TypeError):
+        result['errors'].append(probe.stderr.decode(errors="replace").strip() or "no duration")
+    scan = subprocess.run([ffmpeg, '-v', 'error', '-i', path, '-map', '0', '-c', 'copy', '-f', 'null', '-'],
+                          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    result['errors'] += [line for line in scan.stderr.decode(errors="replace").splitlines() if line.strip()][:20]
+    return result
+
+
+def checksum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as video_file:
+        for chunk in iter(lambda: video_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Work that happens after a recording ended: remux to a faststart mp4, check it, save the thumbnail and avatar,
+# write a json sidecar with the live's details and a checksum. The heavy steps run on a small process pool at a
+# low priority and wait while the disk of the file is busy with recordings, so they never slow down a capture
+class PostProcessor:
+    def __init__(self, logger, session, steps=DEFAULT_STEPS, workers=1, nice=10, ffmpeg="ffmpeg", ffprobe="ffprobe",
+                 disk_busy=None, max_busy=2):
+        self.logger = logger
+        self.session = session
+        self.steps = steps
+        self.nice = nice
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.disk_busy = disk_busy
+        self.max_busy = max_busy
+        self.semaphore = asyncio.Semaphore(workers)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_lower_priority,
+                                                               initargs=(nice,))
+        self.tasks = set()
+
+    def submit(self, path, live=None):
+        if not os.path.isfile(path):
+            return None
+        task = asyncio.get_running_loop().create_task(self._process(path, live or {}))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _heavy(self, path, function, *args):
+        async with self.semaphore:
+            while self.disk_busy is not None and self.disk_busy(path) >= self.max_busy:
+                await asyncio.sleep(30)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, path, *args)
+
+    async def _save(self, url, path):
+        if not url or os.path.exists(path):
+            return
+        try:
+            async with self.session().get(url, timeout=aiohttp.ClientTimeout(total=30)) as res:
+                res.raise_for_status()
+                with open(path, "wb") as image_file:
+                    async for chunk in res.content.iter_chunked(65536):
+                        image_file.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as error:
+            self.logger.debug(f"Could not save {url}: {error!r}")
+
+    async def _step(self, name, path, coro):
+        try:
+            return await coro
+        except (OSError, RuntimeError, concurrent.futures.process.BrokenProcessPool) as error:
+            self.logger.error(f"Post processing step {name} of {path} failed: {error!r}")
+            return None
+
+    async def _process(self, path, live):
+        started = time.time()
+        root = os.path.splitext(path)[0]
+        info = {'file': os.path.basename(path)}
+        if "remux" in self.steps and path.endswith(".mp4"):
+            error = await self._step("remux", path, self._heavy(path, remux, self.ffmpeg))
+            if error:
+                self.logger.error(f"Remuxing {path} failed: {error}")
+        if "check" in self.steps:
+            result = await self._step("check", path, self._heavy(path, check, self.ffmpeg, self.ffprobe))
+            if result is not None:
+                info.update(result)
+                if result['errors']:
+                    self.logger.error(f"{path} has errors: {result['errors'][0]}")
+        if "images" in self.steps:
+            await asyncio.gather(self._save(live.get('live_thumbnail'), f"{root}.jpg"),
+                                 self._save(live.get('user_image'), f"{root}.avatar.jpg"))
+        if "checksum" in self.steps:
+            info['sha256'] = await self._step("checksum", path, self._heavy(path, checksum))
+        if "sidecar" in self.steps:
+            info.update({key: live.get(key) for key in ('live_id', 'screen_id', 'live_title', 'live_comment',
+                                                        'live_url', 'live_date', 'created', 'member_only',
+                                                        'protected', 'live_thumbnail', 'user_image')})
+            try:
+                info['size'] = os.path.getsize(path)
+                with open(f"{root}.info.json", "w", encoding="utf-8") as sidecar:
+                    json.dump(info, sidecar, ensure_ascii=False, indent=2)
+            except OSError as error:
+                self.logger.error(f"Could not write the sidecar of {path}: {error!r}")
+        self.logger.info(f"Post processed {os.path.basename(path)} in {time.time() - started:.0f}s")
+
+    async def close(self, timeout=None):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+        for task in self.tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
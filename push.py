@@ -0,0 +1,87 @@
+import asyncio
+import hmac
+import json
+import time
+from collections import OrderedDict
+import aiohttp
+from aiohttp import web
+import endpoints
+
+
+# Receives the livestart/liveend webhooks twitcasting sends for the users registered with POST /webhooks.
+# The callback url is the one set in the twitcasting application settings and every request carries the
+# application's signature. on_event(movie, broadcaster) gets each new event once, retried or
+# duplicated deliveries are dropped
+class PushReceiver:
+    def __init__(self, logger, signature, on_event, max_seen=1024):
+        self.logger = logger
+        self.signature = signature or ""
+        self.on_event = on_event
+        self.max_seen = max_seen
+        self.seen = OrderedDict()
+        self.registered = set()
+        self.last_event = None
+        self.runner = None
+
+    def is_duplicate(self, movie):
+        key = (str(movie.get('id')), bool(movie.get('is_live')))
+        if key in self.seen:
+            self.seen.move_to_end(key)
+            return True
+        self.seen[key] = True
+        if len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+        return False
+
+    async def handle(self, request):
+        try:
+            payload = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.Response(status=400)
+        if not isinstance(payload, dict) or not self.signature or \
+                not hmac.compare_digest(str(payload.get('signature', '')).encode(), self.signature.encode()):
+            self.logger.debug(f"Rejected a webhook with a wrong signature from {request.remote}")
+            return web.Response(status=403)
+        movie = payload.get('movie') or {}
+        broadcaster = payload.get('broadcaster') or {}
+        if 'id' not in movie:
+            return web.Response(status=400)
+        self.last_event = time.time()
+        if not self.is_duplicate(movie):
+            try:
+                self.on_event(movie, broadcaster)
+            except Exception as e:
+                self.logger.error(e, exc_info=True)
+        # Twitcasting only needs a 200, the event is handled by the main loop
+        return web.Response(text="ok")
+
+    async def start(self, host, port, path="/"):
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.logger.info(f"Listening for twitcasting webhooks on {host}:{port}{path}")
+        return self.runner
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    # Subscribes every watched user to livestart and liveend, users added later are picked up on the next pass
+    async def register(self, poller, headers, user_ids, interval=3600):
+        while True:
+            for user_id in [user_id for user_id in list(user_ids) if user_id not in self.registered]:
+                try:
+                    status, res = await poller.post(f"{endpoints.API_URL}/webhooks",
+                                                    {'user_id': user_id, 'events': ['livestart', 'liveend']},
+                                                    headers=headers())
+                except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as error:
+                    self.logger.debug(f"Could not register the webhook of {user_id}: {error!r}")
+                    continue
+                if status in (200, 201):
+                    self.registered.add(user_id)
+                else:
+                    self.logger.error(f"Could not register the webhook of {user_id} ({status}): {res}")
+            await asyncio.sleep(interval)
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import endpoints
+from metrics import metrics
+
+
+# requests allowed per period in seconds and the burst capacity of each endpoint family
+# Note twitcasting api allows upto 60 requests per minute
+DEFAULT_LIMITS = {
+    'apiv2': {'rate': 60, 'period': 60, 'capacity': 60},
+    'frontendapi': {'rate': 60, 'period': 60, 'capacity': 30},
+    'streamserver': {'rate': 20, 'period': 1, 'capacity': 100},
+    'html': {'rate': 30, 'period': 60, 'capacity': 10},
+}
+
+
+def family_for(url):
+    if url.startswith(endpoints.API_URL):
+        return 'apiv2'
+    if url.startswith(endpoints.FRONTEND_API_URL):
+        return 'frontendapi'
+    if urlsplit(url).path.endswith("streamserver.php"):
+        return 'streamserver'
+    return 'html'
+
+
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate, period, capacity, min_backoff=1, max_backoff=120):
+        self.fill_rate = rate / period
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.throttled = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    # Takes a token and returns how long the caller has to wait before using it
+    # Tokens can go negative so concurrent callers queue up behind each other instead of all waking at once
+    def reserve(self):
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        delay = 0 if self.tokens >= 0 else -self.tokens / self.fill_rate
+        return max(delay, self.blocked_until - now)
+
+    def block_for(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def penalize(self, retry_after=None):
+        self.throttled += 1
+        if retry_after is not None:
+            self.block_for(retry_after)
+        # Answers to requests that were already in flight when the block started belong to the same episode
+        # and must not escalate the backoff again
+        elif not self.is_blocked:
+            self.block_for(self.backoff)
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def relax(self):
+        self.backoff = self.min_backoff
+
+    @property
+    def is_blocked(self):
+        return self.blocked_until > time.monotonic()
+
+
+# Central limiter shared by every request to twitcasting, one token bucket per endpoint family
+class RateLimiter:
+    def __init__(self, logger, limits=None):
+        self.logger = logger
+        self.buckets = {}
+        merged = {family: dict(limit) for family, limit in DEFAULT_LIMITS.items()}
+        for family, limit in (limits or {}).items():
+            merged.setdefault(family, {}).update(limit)
+        for family, limit in merged.items():
+            self.buckets[family] = TokenBucket(limit['rate'], limit['period'], limit.get('capacity', limit['rate']))
+        metrics.gauge('rate_limited_endpoints', lambda: sum(bucket.is_blocked for bucket in self.buckets.values()))
+
+    async def acquire(self, family):
+        delay = self.buckets[family].reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Feed the response status and headers back so the bucket follows what the server tells us
+    def update(self, family, status, headers):
+        bucket = self.buckets[family]
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is not None:
+            try:
+                remaining = int(remaining)
+                bucket.tokens = min(bucket.tokens, remaining)
+                if remaining <= 0 and reset is not None:
+                    bucket.block_for(max(0.0, int(reset) - time.time()))
+            except ValueError:
+                pass
+        if status == 429 or status == 503 or retry_after is not None:
+            metrics.inc('twitcasting_throttled_total', endpoint=family)
+            bucket.penalize(retry_after)
+            self.logger.debug(f"Rate limited on {family} ({status}), waiting {bucket.blocked_until - time.monotonic():.1f}s")
+        elif status < 400:
+            bucket.relax()
+
+    # Used when the server does not say it is rate limiting but answers with garbage (e.g. html instead of json)
+    def penalize(self, family):
+        metrics.inc('twitcasting_throttled_total', endpoint=family)
+        self.buckets[family].penalize()
+
+    def is_limited(self):
+        return any(bucket.is_blocked for bucket in self.buckets.values())
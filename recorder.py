@@ -0,0 +1,226 @@
+import asyncio
+import os
+import time
+from urllib.parse import urljoin
+import aiohttp
+import endpoints
+
+
+# Raised when a stream can't be recorded natively so the download falls back to yt-dlp
+class RecorderUnavailable(Exception):
+    pass
+
+
+def _attributes(line):
+    attributes = {}
+    for part in line.split(":", 1)[-1].split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            attributes[name.strip()] = value.strip().strip('"')
+    return attributes
+
+
+# Minimal m3u8 parser, only what twitcasting's live playlists use
+def parse_playlist(text, base_url):
+    playlist = {'variants': [], 'segments': [], 'init': None, 'target_duration': 2.0, 'ended': False}
+    sequence = 0
+    bandwidth = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-STREAM-INF"):
+            try:
+                bandwidth = int(_attributes(line).get('BANDWIDTH', 0))
+            except ValueError:
+                bandwidth = 0
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            playlist['target_duration'] = float(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MAP"):
+            uri = _attributes(line).get('URI')
+            if uri:
+                playlist['init'] = urljoin(base_url, uri)
+        elif line.startswith("#EXT-X-ENDLIST"):
+            playlist['ended'] = True
+        elif not line.startswith("#"):
+            if bandwidth is not None:
+                playlist['variants'].append((bandwidth, urljoin(base_url, line)))
+                bandwidth = None
+            else:
+                playlist['segments'].append((sequence, urljoin(base_url, line)))
+                sequence += 1
+    return playlist
+
+
+# Records one live by following its hls playlist and appending every new segment to a file,
+# at most buffer_size bytes of a segment are held in memory before they are written and the file is remuxed at the end
+class HLSRecording:
+    def __init__(self, recorder, user_id):
+        self.recorder = recorder
+        self.user_id = user_id
+        self.stop_event = asyncio.Event()
+        self.bytes = 0
+        self.segments = 0
+        self.path = None
+
+    def stop(self):
+        self.stop_event.set()
+
+    async def _fetch_playlist(self, url):
+        async with self.recorder.session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as res:
+            if res.status != 200:
+                return res.status, None
+            return res.status, parse_playlist(await res.text(), str(res.url))
+
+    async def _write(self, url, output_file):
+        async with self.recorder.session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as res:
+            res.raise_for_status()
+            pending = bytearray()
+            async for chunk in res.content.iter_any():
+                pending += chunk
+                if len(pending) >= self.recorder.buffer_size:
+                    await self._flush(output_file, pending)
+                    pending = bytearray()
+            await self._flush(output_file, pending)
+
+    # The disk write runs on a worker thread so a slow disk can't hold up the polling loop
+    async def _flush(self, output_file, data):
+        if data:
+            await asyncio.get_running_loop().run_in_executor(None, output_file.write, bytes(data))
+            self.bytes += len(data)
+
+    async def _wait(self, seconds):
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    # Returns 0 once the live ended after something was recorded like a finished yt-dlp would
+    async def run(self, output):
+        logger = self.recorder.logger
+        url = await self.recorder.resolve(self.user_id)
+        try:
+            status, playlist = await self._fetch_playlist(url)
+            if playlist is not None and playlist['variants']:
+                url = max(playlist['variants'])[1]
+                status, playlist = await self._fetch_playlist(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise RecorderUnavailable(f"playlist failed: {error!r}")
+        if playlist is None:
+            raise RecorderUnavailable(f"playlist returned {status}")
+
+        self.path = os.path.splitext(output)[0] + (".m4s" if playlist['init'] else ".ts")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        logger.debug(f"Recording {url} to {self.path}")
+        last_sequence = None
+        last_progress = time.monotonic()
+        failures = 0
+        segment_failures = 0
+        with open(self.path, "ab", buffering=self.recorder.buffer_size) as output_file:
+            if playlist['init']:
+                await self._write(playlist['init'], output_file)
+            while not self.stop_event.is_set():
+                new = [(sequence, segment) for sequence, segment in playlist['segments']
+                       if last_sequence is None or sequence > last_sequence]
+                if last_sequence is not None and new and new[0][0] > last_sequence + 1:
+                    logger.debug(f"{self.user_id}: missed {new[0][0] - last_sequence - 1} segment(s)")
+                for sequence, segment in new:
+                    if self.stop_event.is_set():
+                        break
+                    last_sequence = sequence
+                    try:
+                        await self._write(segment, output_file)
+                        self.segments += 1
+                        segment_failures = 0
+                        last_progress = time.monotonic()
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                        segment_failures += 1
+                        logger.debug(f"{self.user_id}: segment {sequence} failed: {error!r}")
+                if playlist['ended'] or time.monotonic() - last_progress > self.recorder.stall_timeout \
+                        or segment_failures >= self.recorder.max_segment_failures:
+                    break
+                # Reload after a whole target duration when there was something new, half of it otherwise
+                await self._wait(playlist['target_duration'] / (1 if new else 2))
+                try:
+                    status, reloaded = await self._fetch_playlist(url)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    status, reloaded = repr(error), None
+                if reloaded is None:
+                    failures += 1
+                    logger.debug(f"{self.user_id}: playlist reload failed ({status})")
+                    # The playlist goes away once the live ends
+                    if failures >= 3:
+                        break
+                    continue
+                failures = 0
+                playlist = reloaded
+        if not self.segments:
+            os.remove(self.path)
+            if self.stop_event.is_set():
+                return 1
+            raise RecorderUnavailable("no segment could be downloaded")
+        returncode = await self.recorder.remux(self.path, output)
+        if segment_failures >= self.recorder.max_segment_failures and not self.stop_event.is_set():
+            # Keep what was recorded and let the download manager restart the recording while the user is live
+            logger.error(f"{self.user_id}: {segment_failures} segments in a row failed, stopping the recording")
+            return 1
+        return returncode
+
+
+class HLSRecorder:
+    def __init__(self, logger, poller, buffer_size=1 << 20, stall_timeout=30, max_segment_failures=5,
+                 ffmpeg="ffmpeg"):
+        self.logger = logger
+        self.poller = poller
+        self.buffer_size = buffer_size
+        self.stall_timeout = stall_timeout
+        self.max_segment_failures = max_segment_failures
+        self.ffmpeg = ffmpeg
+
+    # Segments come from the cdn and are not counted against the twitcasting rate limits
+    @property
+    def session(self):
+        return self.poller.session
+
+    def recording(self, user_id):
+        return HLSRecording(self, user_id)
+
+    # Same lookup yt-dlp does, streamserver.php lists the hls playlists of a live user
+    async def resolve(self, user_id):
+        params = {'target': user_id, 'mode': 'client', 'player': 'pc_web'}
+        try:
+            status, res = await self.poller.request(f"{endpoints.SITE_URL}/streamserver.php", params=params,
+                                                    headers={'Accept': 'application/json'})
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            raise RecorderUnavailable(f"streamserver.php failed: {error!r}")
+        if status != 200 or not isinstance(res, dict) or not res.get('movie', {}).get('live'):
+            raise RecorderUnavailable(f"{user_id} is not live on streamserver.php ({status})")
+        streams = (res.get('tc-hls') or {}).get('streams') or {}
+        for quality in ('main', 'mobilesource', 'base'):
+            if streams.get(quality):
+                return streams[quality]
+        if streams:
+            return next(iter(streams.values()))
+        if res.get('hls'):
+            return f"{endpoints.SITE_URL}/{user_id}/metastream.m3u8?mode=source"
+        raise RecorderUnavailable(f"no hls stream for {user_id}")
+
+    # Copies the streams into the final container, the raw recording is kept if ffmpeg isn't available
+    async def remux(self, source, output):
+        args = [self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', source, '-c', 'copy',
+                '-movflags', '+faststart', output]
+        try:
+            process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                           stdout=asyncio.subprocess.DEVNULL,
+                                                           stderr=asyncio.subprocess.PIPE)
+        except (OSError, NotImplementedError) as error:
+            self.logger.error(f"Could not start {self.ffmpeg}, keeping {source}: {error!r}")
+            return 0
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            self.logger.error(f"Remuxing {source} failed, keeping it: {stderr.decode(errors='replace').strip()}")
+            return 0
+        os.remove(source)
+        return 0
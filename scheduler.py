@@ -0,0 +1,161 @@
+import heapq
+import math
+import random
+import time
+from datetime import datetime
+
+
+class UserHistory:
+    def __init__(self, added=None, grace=3600):
+        # Number of go-lives seen for each hour of the day, halved once it grows so old habits fade out
+        self.hour_counts = [0.0] * 24
+        self.live = False
+        self.last_live = None
+        self.last_offline = None
+        # When the user started being watched, see activity()
+        self.added = time.time() if added is None else added
+        self.grace = grace
+        # Last time a live of the user was returned by the public live search, None if it never was
+        self.searched = None
+        # Member's only lives never show up in the public search
+        self.member_only = False
+
+    def record(self, is_live, now):
+        if is_live and not self.live:
+            hour = datetime.fromtimestamp(now).hour
+            self.hour_counts[hour] += 1
+            if sum(self.hour_counts) > 200:
+                self.hour_counts = [count / 2 for count in self.hour_counts]
+        if is_live:
+            self.last_live = now
+        elif self.live:
+            self.last_offline = now
+        self.live = is_live
+
+    # How likely the user is to go live around this time, between 0 and 1
+    # Nothing is known about a user that was never seen live, they are polled as often as an active one at first
+    # and slow down over the grace period like a dormant one
+    def activity(self, now):
+        if self.last_live is None:
+            if not self.grace:
+                return 0.0
+            return max(0.0, 1 - (now - self.added) / self.grace)
+        hour = datetime.fromtimestamp(now).hour
+        total = sum(self.hour_counts)
+        nearby = self.hour_counts[hour - 1] + self.hour_counts[hour] + self.hour_counts[(hour + 1) % 24]
+        hour_share = min(1.0, 3 * nearby / total) if total else 0.0
+        days_since_live = (now - self.last_live) / 86400
+        recency = math.exp(-days_since_live / 7)
+        return max(hour_share, recency * 0.5)
+
+
+# Priority queue of users keyed by the next time they are due to be polled
+# Users that are live, just went offline or usually stream at this hour are polled every min_interval seconds,
+# dormant users drift towards max_interval which is the worst case detection latency
+class PollScheduler:
+    def __init__(self, user_ids, min_interval=1, max_interval=60, recent_window=1800, search_window=7 * 86400,
+                 unknown_grace=3600):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.recent_window = recent_window
+        self.search_window = search_window
+        self.unknown_grace = unknown_grace
+        self.heap = []
+        self.due = {}
+        self.history = {}
+        # While a bulk detection source is healthy offline users only need a slow safety net poll
+        self.covered_until = 0
+        # When go-lives and go-offlines are pushed to us every user is only polled this often to catch missed events
+        self.reconcile_interval = None
+        for user_id in user_ids:
+            self.add(user_id)
+
+    def add(self, user_id, delay=None):
+        if user_id not in self.history:
+            self.history[user_id] = UserHistory(grace=self.unknown_grace)
+        # Spread new users over the first interval so they don't all hit the api in the same tick
+        if delay is None:
+            delay = random.uniform(0, self.min_interval)
+        self._push(user_id, time.time() + delay)
+
+    # Replays a live from the saved state so the habits are known right after a restart
+    def seed(self, user_id, started, ended=None):
+        history = self.history.get(user_id)
+        if history is None:
+            return
+        history.record(True, started)
+        if ended is not None:
+            history.record(False, ended)
+
+    def remove(self, user_id):
+        self.history.pop(user_id, None)
+        self.due.pop(user_id, None)
+
+    def _push(self, user_id, due):
+        self.due[user_id] = due
+        heapq.heappush(self.heap, (due, user_id))
+
+    def interval(self, user_id, now=None):
+        now = time.time() if now is None else now
+        history = self.history[user_id]
+        if self.reconcile_interval is not None:
+            return self.reconcile_interval
+        if history.live:
+            return self.min_interval
+        if history.last_offline is not None and now - history.last_offline < self.recent_window:
+            return self.min_interval
+        # Only users the search is known to return are covered by it, the others keep their own schedule
+        if now < self.covered_until and not history.member_only and history.searched is not None \
+                and now - history.searched < self.search_window:
+            return self.max_interval
+        activity = history.activity(now)
+        return self.max_interval - (self.max_interval - self.min_interval) * activity
+
+    def due_users(self, now=None):
+        now = time.time() if now is None else now
+        users = []
+        while self.heap and self.heap[0][0] <= now:
+            due, user_id = heapq.heappop(self.heap)
+            # Skip stale heap entries left behind by remove() or a reschedule
+            if self.due.get(user_id) != due:
+                continue
+            del self.due[user_id]
+            users.append(user_id)
+        return users
+
+    def time_until_next(self, now=None):
+        now = time.time() if now is None else now
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return self.max_interval
+        return max(0.0, self.heap[0][0] - now)
+
+    def record(self, user_id, is_live, now=None):
+        if user_id not in self.history:
+            return
+        now = time.time() if now is None else now
+        self.history[user_id].record(is_live, now)
+        self._push(user_id, now + self.interval(user_id, now))
+
+    def mark_searched(self, user_id, now=None):
+        if user_id in self.history:
+            self.history[user_id].searched = time.time() if now is None else now
+
+    def mark_member_only(self, user_id):
+        if user_id in self.history:
+            self.history[user_id].member_only = True
+
+    # Push back the next poll of a user whose status is already known from another source
+    def defer(self, user_id, delay, now=None):
+        if user_id not in self.history:
+            return
+        now = time.time() if now is None else now
+        self._push(user_id, max(self.due.get(user_id, now), now + delay))
+
+    # Used when a poll failed, retry at the current interval without touching the history
+    def retry(self, user_id, now=None):
+        if user_id not in self.history:
+            return
+        now = time.time() if now is None else now
+        self._push(user_id, now + self.interval(user_id, now))
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import signal
+import socket
+import time
+
+
+# Exit codes of index.py, 2 is also what argparse exits with on bad arguments
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+
+
+# Sends a state change to systemd(Type=notify units), does nothing when not started by systemd
+def sd_notify(message):
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address or not hasattr(socket, "AF_UNIX"):
+        return False
+    # Abstract namespace sockets are given with a leading @
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(message.encode())
+    except OSError:
+        return False
+    return True
+
+
+def watchdog_interval():
+    usec = os.environ.get("WATCHDOG_USEC")
+    pid = os.environ.get("WATCHDOG_PID")
+    if not usec or (pid and pid != str(os.getpid())):
+        return None
+    try:
+        # Ping twice per watchdog period like systemd recommends
+        return int(usec) / 1_000_000 / 2
+    except ValueError:
+        return None
+
+
+# Signal handling and supervisor integration for the main loop.
+# The first SIGTERM/SIGINT asks the loop to stop so notifications and downloads can be wrapped up,
+# a second one runs the on_force callbacks to stop whatever is still being waited on
+class Service:
+    def __init__(self, logger):
+        self.logger = logger
+        self.stop_event = None
+        self.wake_event = None
+        self.signals = 0
+        self.on_force = []
+        # Set when the program stops itself because of an error instead of being asked to
+        self.exit_code = None
+        self.watchdog = watchdog_interval()
+        self.last_heartbeat = 0
+
+    @property
+    def stopping(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def install(self):
+        loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.wake_event = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.request_stop, signum)
+            except (NotImplementedError, RuntimeError):
+                # Windows has no add_signal_handler, the handler then runs between bytecodes of the main thread
+                signal.signal(signum, lambda signum, frame: loop.call_soon_threadsafe(self.request_stop, signum))
+
+    def request_stop(self, signum=None, exit_code=None):
+        if exit_code is not None and self.exit_code is None:
+            self.exit_code = exit_code
+        # Only a second signal forces the stop, not the program stopping itself from several places
+        if signum is None and self.stopping:
+            return
+        self.signals += 1
+        name = signal.Signals(signum).name if signum is not None else "stop"
+        if self.signals == 1:
+            self.logger.info(f"Received {name}, shutting down")
+            sd_notify("STOPPING=1")
+            self.stop_event.set()
+            self.wake_event.set()
+            return
+        self.logger.info(f"Received {name} again, stopping immediately")
+        for callback in self.on_force:
+            try:
+                callback()
+            except Exception as e:
+                self.logger.debug(e, exc_info=True)
+
+    def ready(self):
+        sd_notify("READY=1")
+
+    # Called from the main loop so the watchdog only gets pinged while the loop is actually making progress,
+    # the status text shows up in systemctl status
+    def heartbeat(self, status=None):
+        now = time.monotonic()
+        if now - self.last_heartbeat < (self.watchdog if self.watchdog is not None else 30):
+            return
+        self.last_heartbeat = now
+        lines = ["WATCHDOG=1"] if self.watchdog is not None else []
+        if status:
+            lines.append(f"STATUS={status}")
+        if lines:
+            sd_notify("\n".join(lines))
+
+    # Ends the current sleep() early, e.g. when a pushed event has to be handled right away
+    def wake(self):
+        if self.wake_event is not None:
+            self.wake_event.set()
+
+    # Sleeps until the timeout, a wake() or a stop request, returns True when stopping
+    async def sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self.wake_event.wait(), max(0, seconds))
+        except asyncio.TimeoutError:
+            pass
+        self.wake_event.clear()
+        return self.stopping
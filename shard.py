@@ -0,0 +1,138 @@
+import argparse
+import bisect
+import hashlib
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from service import EXIT_OK, EXIT_USAGE
+
+
+SHARD_ENV = "AUTO_TWITCASTING_SHARD"
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+
+# Consistent hash ring so adding a worker only moves about 1/N of the users to it
+class HashRing:
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted((_hash(f"{node}#{replica}"), node) for node in nodes for replica in range(replicas))
+        self.keys = [key for key, node in self.ring]
+
+    def node_for(self, key):
+        index = bisect.bisect(self.keys, _hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class Shard:
+    def __init__(self, index=0, count=1):
+        self.index = index
+        self.count = count
+        self.ring = HashRing(range(count))
+
+    @classmethod
+    def from_env(cls):
+        value = os.environ.get(SHARD_ENV)
+        if not value:
+            return cls()
+        index, count = value.split("/")
+        return cls(int(index), int(count))
+
+    @property
+    def enabled(self):
+        return self.count > 1
+
+    @property
+    def name(self):
+        return f"worker-{self.index}"
+
+    def owns(self, user_id):
+        return self.count == 1 or self.ring.node_for(user_id) == self.index
+
+    # Each worker can have its own api credentials so the rate budget grows with the number of workers
+    def credentials(self, shards, client_id, client_secret):
+        if shards and self.index < len(shards):
+            return shards[self.index]['CLIENT_ID'], shards[self.index]['CLIENT_SECRET']
+        return client_id, client_secret
+
+    def path(self, path):
+        if not self.enabled:
+            return path
+        root, ext = os.path.splitext(str(path))
+        return f"{root}-{self.index}{ext}"
+
+
+# Shared sqlite file the workers use to make sure a live is notified and downloaded by exactly one of them,
+# even while users move between workers after the settings change
+class ClaimStore:
+    def __init__(self, path, worker):
+        self.worker = worker
+        self.connection = sqlite3.connect(str(path), isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS claims (
+                                       kind TEXT NOT NULL,
+                                       user_id TEXT NOT NULL,
+                                       movie_id TEXT NOT NULL,
+                                       worker TEXT NOT NULL,
+                                       claimed REAL NOT NULL,
+                                       PRIMARY KEY (kind, user_id, movie_id))""")
+
+    def claim(self, kind, user_id, movie_id):
+        cursor = self.connection.execute("INSERT OR IGNORE INTO claims (kind, user_id, movie_id, worker, claimed) "
+                                         "VALUES (?, ?, ?, ?, ?)",
+                                         (kind, user_id, str(movie_id), self.worker, time.time()))
+        if cursor.rowcount == 1:
+            return True
+        # A worker that restarted can take over its own claims again
+        row = self.connection.execute("SELECT worker FROM claims WHERE kind = ? AND user_id = ? AND movie_id = ?",
+                                      (kind, user_id, str(movie_id))).fetchone()
+        return row is not None and row[0] == self.worker
+
+    def close(self):
+        self.connection.close()
+
+
+# Starts one index.py process per shard and restarts the ones that die until it is stopped
+def main():
+    parser = argparse.ArgumentParser(description="Run auto-twitcasting as several sharded worker processes")
+    parser.add_argument("-w", "--workers", type=int, required=True, help="number of worker processes")
+    args, worker_args = parser.parse_known_args()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.py")
+    processes = {}
+    stopping = False
+
+    def spawn(index):
+        env = dict(os.environ, **{SHARD_ENV: f"{index}/{args.workers}"})
+        processes[index] = subprocess.Popen([sys.executable, script, *worker_args], env=env)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            process.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(args.workers):
+        spawn(index)
+    while not stopping:
+        time.sleep(1)
+        for index, process in list(processes.items()):
+            if process.poll() is not None and not stopping:
+                # Bad arguments won't get better by restarting
+                if process.returncode == EXIT_USAGE:
+                    print(f"Worker {index} exited with code {process.returncode}, stopping")
+                    stop(None, None)
+                    break
+                print(f"Worker {index} exited with code {process.returncode}, restarting it")
+                spawn(index)
+    codes = [process.wait() for process in processes.values()]
+    return next((code for code in codes if code), EXIT_OK)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import sqlite3
+import time
+
+
+# On disk record of every live that was seen and whether it was notified and downloaded,
+# so a restart picks up where it left off instead of notifying and downloading the same live again
+class StateStore:
+    def __init__(self, path):
+        self.path = str(path)
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS lives (
+                                       user_id TEXT NOT NULL,
+                                       movie_id TEXT NOT NULL,
+                                       type TEXT,
+                                       notified INTEGER NOT NULL DEFAULT 0,
+                                       downloaded INTEGER NOT NULL DEFAULT 0,
+                                       started REAL NOT NULL,
+                                       ended REAL,
+                                       PRIMARY KEY (user_id, movie_id))""")
+        # Only the lives that haven't ended are needed at startup so keep them in a small partial index
+        self.connection.execute("CREATE INDEX IF NOT EXISTS open_lives ON lives (user_id) WHERE ended IS NULL")
+
+    def restore(self):
+        rows = self.connection.execute("SELECT user_id, movie_id, type, notified, downloaded FROM lives "
+                                       "WHERE ended IS NULL")
+        return {user_id: {"movie_id": movie_id, "notified": bool(notified), "downloaded": bool(downloaded),
+                          "type": live_type}
+                for user_id, movie_id, live_type, notified, downloaded in rows}
+
+    # Start and end of every live since the given time, oldest first
+    def history(self, since):
+        return self.connection.execute("SELECT user_id, started, ended FROM lives WHERE started >= ? "
+                                       "ORDER BY started", (since,)).fetchall()
+
+    # Returns the saved flags when the live was already seen, e.g. after a short polling error
+    def open_live(self, user_id, movie_id, live_type="Live"):
+        row = self.connection.execute("SELECT notified, downloaded FROM lives WHERE user_id = ? AND movie_id = ?",
+                                      (user_id, str(movie_id))).fetchone()
+        if row is not None:
+            self.connection.execute("UPDATE lives SET ended = NULL WHERE user_id = ? AND movie_id = ?",
+                                    (user_id, str(movie_id)))
+            return {"notified": bool(row[0]), "downloaded": bool(row[1])}
+        self.connection.execute("INSERT INTO lives (user_id, movie_id, type, started) VALUES (?, ?, ?, ?)",
+                                (user_id, str(movie_id), live_type, time.time()))
+        return {"notified": False, "downloaded": False}
+
+    def close_live(self, user_id, movie_id):
+        self.connection.execute("UPDATE lives SET ended = ? WHERE user_id = ? AND movie_id = ? AND ended IS NULL",
+                                (time.time(), user_id, str(movie_id)))
+
+    def mark_notified(self, user_id, movie_id):
+        self.connection.execute("UPDATE lives SET notified = 1 WHERE user_id = ? AND movie_id = ?",
+                                (user_id, str(movie_id)))
+
+    def mark_downloaded(self, user_id, movie_id):
+        self.connection.execute("UPDATE lives SET downloaded = 1 WHERE user_id = ? AND movie_id = ?",
+                                (user_id, str(movie_id)))
+
+    # The download was stopped before the live ended so it is started again after a restart
+    def clear_downloaded(self, user_id, movie_id):
+        self.connection.execute("UPDATE lives SET downloaded = 0 WHERE user_id = ? AND movie_id = ?",
+                                (user_id, str(movie_id)))
+
+    def close(self):
+        self.connection.close()
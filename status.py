@@ -0,0 +1,83 @@
+import asyncio
+import sys
+import threading
+from datetime import datetime
+
+
+# Console stream that keeps the status line at the bottom of the terminal, log lines are written above it
+class StatusStream:
+    def __init__(self, stream, display):
+        self.stream = stream
+        self.display = display
+
+    def write(self, text):
+        with self.display.lock:
+            if self.display.shown:
+                self.stream.write("\r\x1b[K")
+            self.stream.write(text)
+            self.display.shown = False
+            if text.endswith("\n"):
+                self.display.draw()
+
+    def flush(self):
+        self.stream.flush()
+
+
+# Shows what the program is doing, redrawn by the main loop only when something changed.
+# When the output isn't a terminal (service, redirected to a file) a summary line is logged every interval instead
+class StatusDisplay:
+    def __init__(self, stream=None, interactive=None, interval=300):
+        self.stream = stream or sys.stderr
+        self.interactive = self.stream.isatty() if interactive is None else interactive
+        self.interval = interval
+        self.fields = {'watched': 0, 'live': 0, 'downloads': 0, 'cycle': None, 'limited': False}
+        self.line = ""
+        self.shown = False
+        self.lock = threading.Lock()
+
+    # Stream for the console log handler so log lines don't get mixed up with the status line
+    def wrap(self, stream):
+        return StatusStream(stream, self) if self.interactive else stream
+
+    def text(self):
+        fields = self.fields
+        text = f"Watching {fields['watched']} users, {fields['live']} live, {fields['downloads']} downloading"
+        # Rounded so it doesn't redraw on every tiny change of the cycle time
+        if fields['cycle'] is not None:
+            text += f", last check {fields['cycle']:.1f}s"
+        if fields['limited']:
+            text += ", rate limited"
+        return text
+
+    def draw(self):
+        if self.line:
+            self.stream.write(f"[INFO] {datetime.now().replace(microsecond=0)} | {self.line}")
+            self.stream.flush()
+            self.shown = True
+
+    def update(self, **fields):
+        self.fields.update(fields)
+        if not self.interactive:
+            return
+        line = self.text()
+        if line == self.line:
+            return
+        with self.lock:
+            self.line = line
+            if self.shown:
+                self.stream.write("\r\x1b[K")
+            self.draw()
+
+    async def run(self, logger):
+        if self.interactive or not self.interval:
+            return
+        while True:
+            await asyncio.sleep(self.interval)
+            logger.info(self.text())
+
+    def clear(self):
+        with self.lock:
+            if self.shown:
+                self.stream.write("\r\x1b[K")
+                self.stream.flush()
+                self.shown = False
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import time
+from metrics import metrics
+
+
+# Output folders(volumes) the recordings are spread over and an index of every recording already archived.
+# A new recording goes to the volume with the most free space per recording already writing to it, volumes under
+# min_free are skipped and a warning is logged once one drops under warn_free
+class Storage:
+    def __init__(self, logger, roots, index_path, min_free=5 * 1024 ** 3, warn_free=20 * 1024 ** 3, writes=None,
+                 usage_ttl=10):
+        self.logger = logger
+        self.roots = []
+        self.min_free = min_free
+        self.warn_free = warn_free
+        # Callable returning the paths being written to right now
+        self.writes = writes
+        self.usage_ttl = usage_ttl
+        self.usage = {}
+        self.warned = set()
+        self.set_roots(roots)
+        self.connection = sqlite3.connect(str(index_path), isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS archive (
+                                       streamer TEXT NOT NULL,
+                                       live_id TEXT NOT NULL,
+                                       path TEXT NOT NULL,
+                                       size INTEGER,
+                                       archived REAL NOT NULL,
+                                       PRIMARY KEY (streamer, live_id, path))""")
+        # Duplicate checks are answered from memory instead of probing the disks
+        self.archived = {(streamer, live_id) for streamer, live_id in
+                         self.connection.execute("SELECT streamer, live_id FROM archive")}
+        # (streamer, file name) of every recording in the output folders, filled by scan() in the background so
+        # recordings from before the index existed are found too
+        self.on_disk = set()
+        self.scanned = []
+        metrics.gauge('storage_free_bytes', lambda: min((self.free(root) for root in self.roots), default=0))
+
+    def set_roots(self, roots):
+        roots = [os.path.abspath(str(root)) for root in roots]
+        for root in roots:
+            os.makedirs(root, exist_ok=True)
+        self.roots = roots
+
+    def free(self, root):
+        now = time.monotonic()
+        cached = self.usage.get(root)
+        if cached is None or now - cached[0] > self.usage_ttl:
+            try:
+                cached = (now, shutil.disk_usage(root).free)
+            except OSError:
+                cached = (now, 0)
+            self.usage[root] = cached
+        return cached[1]
+
+    def root_of(self, path):
+        path = os.path.abspath(path)
+        for root in sorted(self.roots, key=len, reverse=True):
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return None
+
+    # Volume for a new recording, None when every volume is too full
+    def place(self):
+        writing = {}
+        for path in (self.writes() if self.writes is not None else []):
+            root = self.root_of(path)
+            writing[root] = writing.get(root, 0) + 1
+        candidates = []
+        for root in self.roots:
+            free = self.free(root)
+            self.check(root, free)
+            if free >= self.min_free:
+                candidates.append((free / (1 + writing.get(root, 0)), root))
+        if not candidates:
+            self.logger.error(f"Every output folder has less than {self.min_free / 1024 ** 3:.1f}GB free, "
+                              f"not starting the download")
+            return None
+        return max(candidates)[1]
+
+    def check(self, root, free=None):
+        free = self.free(root) if free is None else free
+        if free < self.warn_free:
+            if root not in self.warned:
+                self.logger.warning(f"{root} only has {free / 1024 ** 3:.1f}GB free")
+                self.warned.add(root)
+        else:
+            self.warned.discard(root)
+
+    @staticmethod
+    def entry(path):
+        return os.path.basename(os.path.dirname(os.path.abspath(path))), os.path.basename(path)
+
+    def _scan(self, roots):
+        found = set()
+        for root in roots:
+            try:
+                with os.scandir(root) as streamers:
+                    for streamer in streamers:
+                        if streamer.is_dir():
+                            found.update((streamer.name, name) for name in os.listdir(streamer.path)
+                                         if name.endswith(".mp4"))
+            except OSError as osError:
+                self.logger.error(f"Could not list the recordings in {root}: {osError}")
+        return found
+
+    async def scan(self):
+        roots = list(self.roots)
+        self.on_disk |= await asyncio.get_running_loop().run_in_executor(None, self._scan, roots)
+        self.scanned = roots
+        self.logger.debug(f"Found {len(self.on_disk)} recordings in {len(roots)} output folder(s)")
+
+    # The output folders are listed again when they changed in the settings
+    async def watch(self, interval=60):
+        while True:
+            if self.scanned != self.roots:
+                await self.scan()
+            await asyncio.sleep(interval)
+            for root in self.roots:
+                self.check(root)
+
+    def is_archived(self, streamer, live_id):
+        return (streamer, str(live_id)) in self.archived
+
+    # Same naming as before, a live that was already archived gets the time added so the old file isn't overwritten.
+    # Answered from memory, the disks are only checked directly until scan() listed the output folders
+    def file_name(self, live_date, live_title, live_id, streamer):
+        file_name = f'{live_date} - {live_title} ({live_id}).mp4'
+        writing = {self.entry(path) for path in (self.writes() if self.writes is not None else [])}
+        if self.is_archived(streamer, live_id) or (streamer, file_name) in self.on_disk or \
+                (streamer, file_name) in writing or (self.scanned != self.roots and any(
+                    os.path.exists(os.path.join(root, streamer, file_name)) for root in self.roots)):
+            file_name = f'{live_date}{time.strftime("%H%M%S")} - {live_title} ({live_id}).mp4'
+        return file_name
+
+    def add(self, streamer, live_id, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO archive (streamer, live_id, path, size, archived) "
+                                "VALUES (?, ?, ?, ?, ?)", (streamer, str(live_id), os.path.abspath(path), size,
+                                                           time.time()))
+        self.archived.add((streamer, str(live_id)))
+        self.on_disk.add(self.entry(path))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import zstandard as zstd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import endpoints
+from bench.mock_server import MockTwitcasting
+from comments import CommentArchiver
+from poller import LivePoller
+from ratelimit import RateLimiter
+
+logger = logging.getLogger("test")
+
+
+def read_ids(path):
+    with open(path, "rb") as comments_file:
+        reader = zstd.ZstdDecompressor().stream_reader(comments_file, read_across_frames=True)
+        return [int(json.loads(line)['id']) for line in reader.read().decode("utf-8").splitlines()]
+
+
+# Archives the lives of the mock server for a while, comment_rate is high enough that most polls get a full page
+async def archive(directory, seconds, users=3, comment_rate=200, restart=False):
+    mock = MockTwitcasting(users=users, live_ratio=1.0, live_window=0.01, comment_rate=comment_rate)
+    url = await mock.start()
+    endpoints.configure(api_url=f"{url}/apiv2")
+    poller = LivePoller(logger, RateLimiter(logger, {'apiv2': {'rate': 6000, 'period': 60, 'capacity': 600}}))
+    await poller.start()
+    try:
+        archiver = CommentArchiver(logger, poller, dict, interval=0.5, max_interval=1, budget=0, flush_interval=0)
+        for _ in range(2 if restart else 1):
+            for user in mock.users.values():
+                archiver.start(user.user_id, user.movie_id, os.path.join(directory, user.user_id, "live.mp4"))
+            await asyncio.sleep(seconds)
+            await archiver.close(timeout=10)
+        return {user.user_id: user.movie_id * 100000 for user in mock.users.values()}
+    finally:
+        await poller.close()
+        await mock.stop()
+
+
+def check(directory, first_ids):
+    for user_id, first_id in first_ids.items():
+        ids = read_ids(os.path.join(directory, user_id, "live.comments.ndjson.zst"))
+        assert ids, user_id
+        # Nothing skipped between the first comment of the live and the last one archived, nothing twice
+        assert ids == list(range(first_id, first_id + len(ids))), user_id
+
+
+def test_busy_lives_have_no_gaps(tmp_path):
+    check(str(tmp_path), asyncio.run(archive(str(tmp_path), 3)))
+
+
+def test_restart_continues_without_duplicates(tmp_path):
+    check(str(tmp_path), asyncio.run(archive(str(tmp_path), 1.5, restart=True)))
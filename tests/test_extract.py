@@ -0,0 +1,69 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract import MemberPageError, MemberPageExtractor, extract_member_page, extract_member_page_lexbor
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "show")
+
+# Saved /show/ pages and what has to be extracted from them, a failure here usually means twitcasting changed
+# the markup of the page
+EXPECTED = {
+    'member.html': (True, {'title': "メン限 雑談 & お知らせ", 'subtitle': "メンバーさんありがとう",
+                           'is_protected': False, 'date': "20240501",
+                           'image': "https://imagegw02.twitcasting.tv/image3s/pbs.twimg.com/profile_images/"
+                                    "robocosan_bigger.jpg",
+                           'thumbnail': "https://apiv2-image.twitcasting.tv/image3/781234567-l.jpg"}),
+    'protected.html': (True, {'title': "合言葉配信", 'subtitle': "パスワードは概要欄", 'is_protected': True,
+                              'date': "20240612",
+                              'image': "https://imagegw02.twitcasting.tv/image3s/natsuiromatsuri_bigger.jpg",
+                              'thumbnail': "https://apiv2-image.twitcasting.tv/image3/782000001-l.jpg"}),
+    'missing_label.html': (False, {'title': "歌枠", 'subtitle': "歌枠", 'is_protected': False, 'date': "20240703",
+                                   'image': "https://imagegw02.twitcasting.tv/image3s/yozoramel_bigger.jpg",
+                                   'thumbnail': "https://apiv2-image.twitcasting.tv/image3/783000002-l.jpg"}),
+    'nav_after_box.html': (True, {'title': "メン限", 'subtitle': "subtitle", 'is_protected': False,
+                                  'date': "20240815",
+                                  'image': "https://imagegw02.twitcasting.tv/image3s/akirosenthal_bigger.jpg",
+                                  'thumbnail': "https://apiv2-image.twitcasting.tv/image3/784000003-l.jpg"}),
+}
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name), "rb") as page_file:
+        return page_file.read()
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_stream_extractor(name):
+    assert extract_member_page("user", load(name).decode("utf-8")) == EXPECTED[name]
+
+
+# Chunks that split tags, character references and multi byte characters
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_stream_extractor_chunked(name, chunk_size):
+    page = load(name)
+    extractor = MemberPageExtractor()
+    for start in range(0, len(page), chunk_size):
+        if extractor.feed_bytes(page[start:start + chunk_size]):
+            break
+    else:
+        extractor.feed_bytes(b"", True)
+    assert extractor.result("user") == EXPECTED[name]
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_lexbor_extractor(name):
+    pytest.importorskip("selectolax")
+    assert extract_member_page_lexbor("user", load(name).decode("utf-8")) == EXPECTED[name]
+
+
+@pytest.mark.parametrize("backend", ["stream", "lexbor"])
+def test_missing_movie(backend):
+    if backend == "lexbor":
+        pytest.importorskip("selectolax")
+    page = '<div class="tw-user-nav2-icon"><img src="//mock/icon.jpg"></div><p>no movies</p>'
+    with pytest.raises(MemberPageError):
+        extract_member_page("user", page, backend)